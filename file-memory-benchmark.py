@@ -0,0 +1,44 @@
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+from pathlib import PurePath
+
+from rfi_file_monitor.file import File, FileStatus
+
+parser = argparse.ArgumentParser(description='Measure the memory used per file tracked by the RFI-file-monitor')
+parser.add_argument('--nfiles', type=int, help='The number of files that will be tracked', default=1000000)
+parser.add_argument('--root', type=str, help='The monitored directory the files are assumed to be in', default='/data/acquisition/2020-10-01')
+parser.add_argument('--depth', type=int, help='The number of subdirectories between the root and the files', default=2)
+
+args = parser.parse_args()
+
+class LegacyFile:
+    # the layout of File before it was made compact
+    def __init__(self, filename, relative_filename, created, status, row_reference):
+        self._filename = filename
+        self._relative_filename = relative_filename
+        self._created = created
+        self._status = status
+        self._row_reference = row_reference
+        self._operation_metadata = dict()
+
+def measure(cls):
+    gc.collect()
+    tracemalloc.start()
+    files_dict = dict()
+    for i in range(args.nfiles):
+        relative_filename = os.path.join(*(f'dir{i % (10 ** (d + 1))}' for d in range(args.depth)), f'file{i}.tif')
+        filename = os.path.join(args.root, relative_filename)
+        files_dict[filename] = cls(filename, PurePath(relative_filename), time.time(), FileStatus.SUCCESS, None)
+    # this includes the filenames, which are shared with the keys of the files dict
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / args.nfiles
+
+before = measure(LegacyFile)
+after = measure(File)
+print(f'Tracking {args.nfiles} files in {args.root}')
+print(f'before: {before:.0f} bytes per file')
+print(f'after:  {after:.0f} bytes per file ({100 * (before - after) / before:.0f} % less)')
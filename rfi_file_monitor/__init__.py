@@ -1,12 +1,13 @@
 import logging
 import sys
 
-from .application import Application
-
 __version__ = "0.1.0"
 
 # main entrypoint
 def main():
+    # imported here, so that the headless monitor does not load the GUI
+    from .application import Application
+
     logging.basicConfig(level=logging.DEBUG)
     logging.info('Started')
     app = Application()
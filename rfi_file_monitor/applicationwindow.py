@@ -2,40 +2,49 @@ import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("Gdk", "3.0")
 from gi.repository import GLib, Gtk, Gdk
-from watchdog.events import FileCreatedEvent, FileModifiedEvent, PatternMatchingEventHandler
-from watchdog.observers import Observer
 import yaml
 
 import logging
 from collections import OrderedDict
-from threading import RLock, Thread
+from threading import Event, RLock, Thread
 from time import time, ctime
 from pathlib import PurePath
 from typing import OrderedDict as OrderedDictType
 from typing import Final, List, Optional
 import importlib.metadata
-import os
+import platform
 
-from .utils import add_action_entries, LongTaskWindow, WidgetParams
+from .utils import add_action_entries, LongTaskWindow, WidgetParams, JOURNAL_FILE, HISTORY_FILE
 from .file import FileStatus, File
-from .job import Job
+from .scheduler import Scheduler, resolve_dependencies, MAX_JOBS, DEFAULT_JOBS
+from .quiescence import QuiescenceDetector
+from .monitor import DirectoryMonitor, EventHandler, IGNORE_PATTERNS
+from .backlog import BacklogIngester
+from .journal import Journal, configuration_id
+from .retention import FileHistory, FileRetention, RETENTION_INTERVAL
+from .priority import QueuePolicy, QUEUE_POLICIES, queue_policy
+from .bandwidth import BandwidthSchedule, global_limiter, MB
 
 class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
 
     #pylint: disable=no-member
-    MAX_JOBS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    MAX_JOBS = MAX_JOBS
 
     def __init__(self, *args, **kwargs):
         logging.debug('Calling ApplicationWindow __init__')
         Gtk.ApplicationWindow.__init__(self, *args, **kwargs)
         WidgetParams.__init__(self)
 
-        self._monitor: Final[Observer] = None
+        self._monitor: Final[DirectoryMonitor] = None
+        self._event_handler: Final[EventHandler] = None
+        self._quiescence_detector: Final[QuiescenceDetector] = None
+        self._backlog_ingester: Final[BacklogIngester] = None
+        self._journal: Final[Journal] = None
+        self._retention: Final[FileRetention] = None
+        self._retention_timeout_id: Final[int] = None
         self._files_dict_lock = RLock()
         self._files_dict: OrderedDictType[str, File] = OrderedDict()
-        self._jobs_list: Final[List[Job]] = list()
-        self._njobs_running: Final[int] = 0
-        self._timeout_id: Final[int] = 0
+        self._scheduler: Final[Scheduler] = None
 
         self._yaml_file: Final[str] = None
 
@@ -218,10 +227,10 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
             adjustment=Gtk.Adjustment(
                 lower=1,
                 upper=self.MAX_JOBS,
-                value=max(self.MAX_JOBS//2, 1),
+                value=DEFAULT_JOBS,
                 page_size=0,
                 step_increment=1),
-            value=max(self.MAX_JOBS//2, 1),
+            value=DEFAULT_JOBS,
             update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
             numeric=True,
             climb_rate=1,
@@ -229,6 +238,263 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
             hexpand=False, vexpand=False), 'max_threads')
         max_threads_grid.attach(max_threads_spinbutton, 1, 0, 1, 1)
 
+        autotune_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Tune the number of files per operation automatically',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'autotune_active')
+        max_threads_grid.attach(autotune_checkbutton, 2, 0, 1, 1)
+        self._autotune_label = Gtk.Label(
+                label='',
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=False)
+        max_threads_grid.attach(self._autotune_label, 3, 0, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 3, 1, 1
+        )
+
+        pipeline_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Run operations as a pipeline, with a separate pool of threads for each operation',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'pipeline_operations')
+        advanced_options_child.attach(pipeline_checkbutton, 0, 4, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 5, 1, 1
+        )
+
+        save_detection_grid = Gtk.Grid(
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+            column_spacing=5
+        )
+        advanced_options_child.attach(save_detection_grid, 0, 6, 1, 1)
+        save_detection_grid.attach(Gtk.Label(
+                label='Consider files saved when',
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False,
+            ),
+            0, 0, 1, 1,
+        )
+        save_detection_combobox = Gtk.ComboBoxText(
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False)
+        save_detection_combobox.append('modified', 'they are no longer being modified')
+        save_detection_combobox.append('closed', 'they are closed after writing (Linux only)')
+        save_detection_combobox.append('quiescent', 'their size and modification time have been stable for')
+        save_detection_combobox.set_active_id('modified')
+        self.register_widget(save_detection_combobox, 'save_detection')
+        save_detection_grid.attach(save_detection_combobox, 1, 0, 1, 1)
+        quiescence_spinbutton = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=3600,
+                value=5,
+                page_size=0,
+                step_increment=1),
+            value=5,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=5,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'quiescence_period')
+        save_detection_grid.attach(quiescence_spinbutton, 2, 0, 1, 1)
+        save_detection_grid.attach(Gtk.Label(label='seconds (for network filesystems)'), 3, 0, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 7, 1, 1
+        )
+
+        recursive_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Monitor subdirectories (subtrees are polled when running out of inotify watches)',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'monitor_recursively')
+        advanced_options_child.attach(recursive_checkbutton, 0, 8, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 9, 1, 1
+        )
+
+        existing_files_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Process files that already exist when monitoring starts',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'process_existing_files')
+        advanced_options_child.attach(existing_files_checkbutton, 0, 10, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 11, 1, 1
+        )
+
+        journal_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Keep a journal of processed files, to skip them after a restart and resume interrupted ones',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'journal_active')
+        advanced_options_child.attach(journal_checkbutton, 0, 12, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 13, 1, 1
+        )
+
+        retention_grid = Gtk.Grid(
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+            column_spacing=5, row_spacing=5
+        )
+        advanced_options_child.attach(retention_grid, 0, 14, 1, 1)
+        max_rows_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Only keep the last',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'retention_max_rows_active')
+        retention_grid.attach(max_rows_checkbutton, 0, 0, 1, 1)
+        max_rows_spinbutton = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=100,
+                upper=10000000,
+                value=10000,
+                page_size=0,
+                step_increment=1),
+            value=10000,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=5,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'retention_max_rows')
+        retention_grid.attach(max_rows_spinbutton, 1, 0, 1, 1)
+        retention_grid.attach(Gtk.Label(label='finished files in the list', halign=Gtk.Align.START), 2, 0, 1, 1)
+        max_age_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Remove successful files from the list after',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'retention_max_age_active')
+        retention_grid.attach(max_age_checkbutton, 0, 1, 1, 1)
+        max_age_spinbutton = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=100000,
+                value=60,
+                page_size=0,
+                step_increment=1),
+            value=60,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=5,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'retention_max_age')
+        retention_grid.attach(max_age_spinbutton, 1, 1, 1, 1)
+        retention_grid.attach(Gtk.Label(label='minutes', halign=Gtk.Align.START), 2, 1, 1, 1)
+        archive_checkbutton = self.register_widget(Gtk.CheckButton(
+                label=f'Archive removed files to {HISTORY_FILE}',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'retention_archive')
+        retention_grid.attach(archive_checkbutton, 0, 2, 3, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 15, 1, 1
+        )
+
+        queue_policy_grid = Gtk.Grid(
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+            column_spacing=5
+        )
+        advanced_options_child.attach(queue_policy_grid, 0, 16, 1, 1)
+        queue_policy_grid.attach(Gtk.Label(
+                label='Process waiting files',
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False,
+            ),
+            0, 0, 1, 1,
+        )
+        queue_policy_combobox = Gtk.ComboBoxText(
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False)
+        for policy in QUEUE_POLICIES.values():
+            queue_policy_combobox.append(policy.NAME, policy.DESCRIPTION)
+        queue_policy_combobox.set_active_id(QueuePolicy.NAME)
+        self.register_widget(queue_policy_combobox, 'queue_policy')
+        queue_policy_grid.attach(queue_policy_combobox, 1, 0, 1, 1)
+        queue_patterns_entry = self.register_widget(Gtk.Entry(
+            tooltip_text='Comma separated glob patterns, highest priority first, e.g. *.log, *.h5',
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False), 'queue_priority_patterns')
+        queue_policy_grid.attach(queue_patterns_entry, 2, 0, 1, 1)
+
+        advanced_options_child.attach(Gtk.Separator(
+                orientation=Gtk.Orientation.HORIZONTAL,
+                halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+                hexpand=True, vexpand=True,
+            ),
+            0, 17, 1, 1
+        )
+
+        bandwidth_grid = Gtk.Grid(
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+            column_spacing=5
+        )
+        advanced_options_child.attach(bandwidth_grid, 0, 18, 1, 1)
+        bandwidth_checkbutton = self.register_widget(Gtk.CheckButton(
+                label='Limit the bandwidth of all uploads to',
+                active=False,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), 'bandwidth_limit_active')
+        bandwidth_grid.attach(bandwidth_checkbutton, 0, 0, 1, 1)
+        bandwidth_spinbutton = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=100000,
+                value=100,
+                page_size=0,
+                step_increment=1),
+            value=100,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=5,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'bandwidth_limit')
+        bandwidth_grid.attach(bandwidth_spinbutton, 1, 0, 1, 1)
+        bandwidth_grid.attach(Gtk.Label(label='MB/s, except', halign=Gtk.Align.START), 2, 0, 1, 1)
+        bandwidth_schedule_entry = self.register_widget(Gtk.Entry(
+            tooltip_text='Time-of-day limits in MB/s, with 0 meaning unlimited, e.g. 08:00-18:00=10, 22:00-06:00=0',
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False), 'bandwidth_schedule')
+        bandwidth_grid.attach(bandwidth_schedule_entry, 3, 0, 1, 1)
+
         paned = Gtk.Paned(wide_handle=True,
             orientation=Gtk.Orientation.VERTICAL,
             halign=Gtk.Align.FILL, valign=Gtk.Align.FILL,
@@ -321,20 +587,39 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
             # disable the monitor
             self._monitor.stop()
             self._monitor = None
-            GLib.source_remove(self._timeout_id)
+            if self._backlog_ingester is not None:
+                self._backlog_ingester.stop()
+                self._backlog_ingester = None
+            self._event_handler.stop()
+            self._event_handler = None
+            if self._quiescence_detector is not None:
+                self._quiescence_detector.stop()
+                self._quiescence_detector = None
+            scheduler = self._scheduler
+            scheduler.stop()
+            self._scheduler = None
+            self._autotune_label.set_text('')
+            if self._journal is not None:
+                self._journal.stop()
+                self._journal = None
+            if self._retention is not None:
+                GLib.source_remove(self._retention_timeout_id)
+                self._retention_timeout_id = None
+                self._retention.close()
+                self._retention = None
             with self._files_dict_lock:
                 self._files_dict.clear()
-                self._njobs_running = 0
-            for job in self._jobs_list:
-                job.should_exit = True
-            self._jobs_list.clear()
-
-            self._directory_chooser_button.set_sensitive(True)
             self._monitor_stop_button.set_sensitive(False)
-            self._monitor_play_button.set_sensitive(True)
-            self._controls_operations_button.set_sensitive(True)
-            for operation in self._operations_box:
-                operation.set_sensitive(True)
+
+            # running operations need to finish before they can be cleaned up
+            task_window = LongTaskWindow(self)
+            task_window.set_text("<b>Waiting for running operations to finish</b>")
+            task_window.show()
+            watch_cursor = Gdk.Cursor.new_for_display(Gdk.Display.get_default(), Gdk.CursorType.WATCH)
+            task_window.get_window().set_cursor(watch_cursor)
+
+            thread = PostflightCleanupThread(self, task_window, scheduler)
+            thread.start()
 
         # play clicked
         elif button == self._monitor_play_button:
@@ -350,49 +635,118 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
     def file_created_cb(self, *user_data):
         file_path = user_data[0]
         with self._files_dict_lock:
-            if file_path in self._files_dict:
+            if self._scheduler is None:
+                # monitor has been stopped already
+                pass
+            elif file_path in self._files_dict and self._files_dict[file_path].status == FileStatus.CREATED:
+                # found by the BacklogIngester while it was being written
+                logging.debug(f"{file_path} has been created already")
+            elif file_path in self._files_dict:
                 logging.warning(f"{file_path} has been recreated! Ignoring...")
             else:
                 logging.debug(f"New file {file_path} created")
-                # add new entry to model
-                _creation_timestamp = time()
-                _relative_file_path = PurePath(file_path).relative_to(self.params.monitored_directory)
-                iter = self._files_tree_model.append(parent=None, row=[
-                    str(_relative_file_path),
-                    _creation_timestamp,
-                    int(FileStatus.CREATED),
-                    "All",
-                    0.0,
-                    "0.0 %",
-                    ])
-                _row_reference = Gtk.TreeRowReference.new(self._files_tree_model, self._files_tree_model.get_path(iter))
-                # create its children, one for each operation
-                for _operation in self._operations_box:
-                    self._files_tree_model.append(parent=iter, row=[
-                        "",
-                        0,
-                        int(FileStatus.QUEUED),
-                        _operation.NAME,
-                        0.0,
-                        "0.0 %",
-                    ])
-                _file = File(filename=file_path, relative_filename=_relative_file_path, created=_creation_timestamp, status=FileStatus.CREATED, row_reference=_row_reference)
-                self._files_dict[file_path] = _file
+                _file = self._add_file(file_path)
+                self._scheduler.file_created(_file)
         return GLib.SOURCE_REMOVE
 
+    def existing_files_cb(self, file_paths: List[str], done: Event):
+        """
+        Registers a chunk of files found by the BacklogIngester, which are
+        considered saved already.
+        """
+        with self._files_dict_lock:
+            if self._scheduler is not None:
+                for file_path in file_paths:
+                    if file_path in self._files_dict:
+                        continue
+                    _file = self._add_file(file_path)
+                    self._scheduler.file_saved(_file)
+        done.set()
+        return GLib.SOURCE_REMOVE
+
+    def recent_files_cb(self, file_paths: List[str], done: Event):
+        """
+        Registers a chunk of files found by the BacklogIngester that were
+        modified after monitoring started, and are considered created only.
+        """
+        with self._files_dict_lock:
+            if self._scheduler is not None:
+                for file_path in file_paths:
+                    if file_path in self._files_dict:
+                        continue
+                    _file = self._add_file(file_path)
+                    self._scheduler.file_created(_file)
+                    if self._quiescence_detector is not None:
+                        self._quiescence_detector.add(file_path)
+        done.set()
+        return GLib.SOURCE_REMOVE
+
+    def _submit_recent_files(self, file_paths: List[str]):
+        # runs in the BacklogIngester thread
+        done = Event()
+        GLib.idle_add(self.recent_files_cb, file_paths, done, priority=GLib.PRIORITY_HIGH)
+        done.wait()
+
+    def _submit_existing_files(self, file_paths: List[str]):
+        # runs in the BacklogIngester thread
+        done = Event()
+        GLib.idle_add(self.existing_files_cb, file_paths, done, priority=GLib.PRIORITY_LOW)
+        done.wait()
+
+    def _add_file(self, file_path: str) -> File:
+        # must be called from the GUI thread, while holding the files dict lock
+        # add new entry to model
+        _creation_timestamp = time()
+        _relative_file_path = PurePath(file_path).relative_to(self.params.monitored_directory)
+        iter = self._files_tree_model.append(parent=None, row=[
+            str(_relative_file_path),
+            _creation_timestamp,
+            int(FileStatus.CREATED),
+            "All",
+            0.0,
+            "0.0 %",
+            ])
+        _row_reference = Gtk.TreeRowReference.new(self._files_tree_model, self._files_tree_model.get_path(iter))
+        # create its children, one for each operation
+        for _operation in self._operations_box:
+            self._files_tree_model.append(parent=iter, row=[
+                "",
+                0,
+                int(FileStatus.QUEUED),
+                _operation.NAME,
+                0.0,
+                "0.0 %",
+            ])
+        _file = File(filename=file_path, relative_filename=_relative_file_path, created=_creation_timestamp, status=FileStatus.CREATED, row_reference=_row_reference)
+        self._files_dict[file_path] = _file
+        return _file
+
+    def _update_autotune_label_cb(self, windows):
+        if self._scheduler is not None:
+            self._autotune_label.set_text('Files per operation: ' + ', '.join(str(window) for window in windows))
+        return GLib.SOURCE_REMOVE
+
+    def _retention_timeout_cb(self):
+        with self._files_dict_lock:
+            evicted = self._retention.evict(self._files_dict)
+        for _file in evicted:
+            if _file.row_reference.valid():
+                self._files_tree_model.remove(self._files_tree_model.get_iter(_file.row_reference.get_path()))
+        return GLib.SOURCE_CONTINUE
+
     def file_changes_done_cb(self, file_path):
         with self._files_dict_lock:
-            if file_path not in self._files_dict:
+            if self._scheduler is None:
+                # monitor has been stopped already
+                pass
+            elif file_path not in self._files_dict:
                 logging.warning(f"{file_path} has not been created yet! Ignoring...")
             elif self._files_dict[file_path].status != FileStatus.CREATED:
                 # looks like this file has been saved again!
                 logging.warning(f"{file_path} has been saved again?? Ignoring!")
             else:
                 logging.debug(f"File {file_path} has been saved")
-                file = self._files_dict[file_path]
-                file.status = FileStatus.SAVED
-                path = file.row_reference.get_path()
-                self._files_tree_model[path][2] = int(FileStatus.SAVED) 
+                self._scheduler.file_saved(self._files_dict[file_path])
 
     def update_monitor_switch_sensitivity(self):
         if self.params.monitored_directory and \
@@ -443,6 +797,7 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
                     new_operation.index = len(self._operations_box)
                     self._operations_box.pack_start(new_operation, False, False, 0)
                     new_operation.update_from_dict(op['params'])
+                    new_operation.depends_on = op.get('depends_on')
                     new_operation.show_all()
                     break
             else:
@@ -451,7 +806,7 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
         self.update_monitor_switch_sensitivity()
 
     def _write_to_yaml(self):
-        yaml_dict = dict(configuration=self.params, operations=[dict(name=op.NAME, params=op.params) for op in self._operations_box])
+        yaml_dict = dict(configuration=self.params, operations=[op.to_dict() for op in self._operations_box])
         logging.debug(f'{yaml.safe_dump(yaml_dict)=}')
         with open(self._yaml_file, 'w') as f:
             yaml.safe_dump(yaml_dict, f)
@@ -503,49 +858,18 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
             dialog.destroy()
         
 
-    def files_dict_timeout_cb(self, *user_data):
-        """
-        This function runs every second, and will take action based on the status of all files in the dict
-        It runs in the GUI thread, so GUI updates are allowed here.
-        """
-        with self._files_dict_lock:
-            for _filename, _file in self._files_dict.items():
-                #logging.debug(f"timeout_cb: {_filename} found as {str(_file.status)}")
-                if _file.status == FileStatus.CREATED:
-                    logging.debug(f"files_dict_timeout_cb: {_filename} was CREATED")
-                    if self.params.status_promotion_active and \
-                        (time() - _file.created) >  self.params.status_promotion_delay:
-                        # promote to SAVED!
-                        _file.status = FileStatus.SAVED
-                        path = _file.row_reference.get_path()
-                        self._files_tree_model[path][2] = int(FileStatus.SAVED) 
-                        logging.debug(f"files_dict_timeout_cb: promoting {_filename} to SAVED")
-                        
-                elif _file.status == FileStatus.SAVED:
-                    if self._njobs_running < self.params.max_threads:
-                        # launch a new job
-                        logging.debug(f"files_dict_timeout_cb: launching new job for {_filename}")
-                        job = Job(self, _file)
-                        self._jobs_list.append(job)
-                        job.start()
-                        self._njobs_running += 1
-                    else:
-                        # queue the job
-                        logging.debug(f"files_dict_timeout_cb: adding {_filename} to queue for future processing")
-                        _file.status = FileStatus.QUEUED
-                        path = _file.row_reference.get_path()
-                        self._files_tree_model[path][2] = int(_file.status)
-                elif _file.status == FileStatus.QUEUED:
-                    if self._njobs_running < self.params.max_threads:
-                        # try and launch a new job
-                        logging.debug(f"files_dict_timeout_cb: launching queued job for {_filename}")
-                        job = Job(self, _file)
-                        self._jobs_list.append(job)
-                        job.start()
-                        self._njobs_running += 1
-        return GLib.SOURCE_CONTINUE
+    def _postflight_cleanup_cb(self, task_window: LongTaskWindow):
+        task_window.get_window().set_cursor(None)
+        task_window.destroy()
+
+        self._directory_chooser_button.set_sensitive(True)
+        self._monitor_play_button.set_sensitive(True)
+        self._controls_operations_button.set_sensitive(True)
+        for operation in self._operations_box:
+            operation.set_sensitive(True)
+        return GLib.SOURCE_REMOVE
 
-    def _preflight_check_cb(self, task_window: LongTaskWindow, exception_msgs: Optional[List[str]]):
+    def _preflight_check_cb(self, task_window: LongTaskWindow, exception_msgs: Optional[List[str]], journal: Optional[Journal]):
         task_window.get_window().set_cursor(None)
         task_window.destroy()
 
@@ -561,11 +885,59 @@ class ApplicationWindow(Gtk.ApplicationWindow, WidgetParams):
 
         # cleanup tree model, launch the monitor
         self._files_tree_model.clear()
-        self._timeout_id = GLib.timeout_add_seconds(1, self.files_dict_timeout_cb, priority=GLib.PRIORITY_DEFAULT)
+        self._journal = journal
+        if journal is not None:
+            journal.start()
+        if self.params.retention_max_rows_active or self.params.retention_max_age_active:
+            self._retention = FileRetention(
+                max_rows=int(self.params.retention_max_rows) if self.params.retention_max_rows_active else None,
+                max_age=self.params.retention_max_age * 60 if self.params.retention_max_age_active else None,
+                history=FileHistory(str(HISTORY_FILE)) if self.params.retention_archive else None,
+            )
+            self._retention_timeout_id = GLib.timeout_add_seconds(RETENTION_INTERVAL, self._retention_timeout_cb)
+        self._scheduler = Scheduler(
+            operations=list(self._operations_box),
+            max_threads=self.params.max_threads,
+            promotion_delay=self.params.status_promotion_delay if self.params.status_promotion_active else None,
+            pipeline=self.params.pipeline_operations,
+            journal=journal,
+            file_done_cb=self._retention.file_done if self._retention is not None else None,
+            autotune=self.params.autotune_active,
+            windows_cb=lambda windows: GLib.idle_add(self._update_autotune_label_cb, windows, priority=GLib.PRIORITY_DEFAULT_IDLE),
+            queue_policy=queue_policy(self.params.queue_policy, self.params.queue_priority_patterns),
+        )
+        self._scheduler.start()
+        if self.params.autotune_active:
+            self._update_autotune_label_cb(self._scheduler.windows)
+
+        if self.params.save_detection == 'quiescent':
+            self._quiescence_detector = QuiescenceDetector(
+                period=self.params.quiescence_period,
+                callback=lambda file_path: GLib.idle_add(self.file_changes_done_cb, file_path, priority=GLib.PRIORITY_DEFAULT_IDLE),
+                path=self.params.monitored_directory,
+                created_cb=lambda file_path: GLib.idle_add(self.file_created_cb, file_path, priority=GLib.PRIORITY_HIGH),
+                recursive=self.params.monitor_recursively,
+                ignore_patterns=IGNORE_PATTERNS,
+            )
+            self._quiescence_detector.start()
 
-        self._monitor = Observer()
-        self._monitor.schedule(EventHandler(self), self.params.monitored_directory, recursive=False, )
+        self._event_handler = EventHandler(self, self.params.save_detection)
+        self._monitor = DirectoryMonitor(self._event_handler, self.params.monitored_directory, recursive=self.params.monitor_recursively)
         self._monitor.start()
+
+        # when not processing all existing files, resume the interrupted ones only
+        if self.params.process_existing_files or (journal is not None and journal.interrupted):
+            self._backlog_ingester = BacklogIngester(
+                path=self.params.monitored_directory,
+                submit=self._submit_existing_files,
+                wait_for_scheduler=self._scheduler.wait_for_nwaiting,
+                recursive=self.params.monitor_recursively,
+                ignore_patterns=IGNORE_PATTERNS,
+                skip=journal.is_completed if journal is not None else None,
+                file_paths=None if self.params.process_existing_files else journal.interrupted,
+                submit_recent=self._submit_recent_files,
+            )
+            self._backlog_ingester.start()
         self._monitor_stop_button.set_sensitive(True)
         self._monitor_play_button.set_sensitive(False)
         self._directory_chooser_button.set_sensitive(False)
@@ -588,33 +960,49 @@ class PreflightCheckThread(Thread):
                 logging.exception(f"Exception caught from {operation.NAME}")
                 exception_msgs.append('* ' + str(e))
 
+        try:
+            resolve_dependencies(list(self._appwindow._operations_box))
+        except ValueError as e:
+            exception_msgs.append('* ' + str(e))
+
+        if self._appwindow.params.save_detection == 'closed' and platform.system() != 'Linux':
+            exception_msgs.append('* Detecting files that are closed after writing is only supported on Linux')
+
+        if self._appwindow.params.bandwidth_limit_active:
+            try:
+                global_limiter.configure(BandwidthSchedule(self._appwindow.params.bandwidth_schedule, self._appwindow.params.bandwidth_limit * MB))
+            except ValueError as e:
+                exception_msgs.append('* ' + str(e))
+
+        journal = None
+        if not exception_msgs and self._appwindow.params.journal_active:
+            try:
+                journal = Journal(str(JOURNAL_FILE), configuration_id(self._appwindow._operations_box))
+            except Exception as e:
+                logging.exception(f"Could not open journal {JOURNAL_FILE}")
+                exception_msgs.append(f'* Could not open journal {JOURNAL_FILE}: {e}')
+
         if exception_msgs:
                 for operation in self._appwindow._operations_box:
                     operation.postflight_cleanup()
+                global_limiter.configure(None)
         
-        GLib.idle_add(self._appwindow._preflight_check_cb, self._task_window, exception_msgs, priority=GLib.PRIORITY_DEFAULT_IDLE)
+        GLib.idle_add(self._appwindow._preflight_check_cb, self._task_window, exception_msgs, journal, priority=GLib.PRIORITY_DEFAULT_IDLE)
 
-
-class EventHandler(PatternMatchingEventHandler):
-    def __init__(self, appwindow: ApplicationWindow):
+class PostflightCleanupThread(Thread):
+    def __init__(self, appwindow: ApplicationWindow, task_window: LongTaskWindow, scheduler: Scheduler):
+        super().__init__()
         self._appwindow = appwindow
-        super(EventHandler, self).__init__(ignore_patterns=['*.swp', '*.swx'])
-        
-    def on_created(self, event):
-        # ignore directories being created
-        if not isinstance(event, FileCreatedEvent):
-            return
-        
-        file_path = event.src_path
-        logging.debug(f"Monitor found {file_path} for event type CREATED")
-        GLib.idle_add(self._appwindow.file_created_cb, file_path, priority=GLib.PRIORITY_HIGH)
+        self._task_window = task_window
+        self._scheduler = scheduler
 
-    def on_modified(self, event):
-        # ignore directories being modified
-        if not isinstance(event, FileModifiedEvent):
-            return
+    def run(self):
+        self._scheduler.join()
+        for operation in self._appwindow._operations_box:
+            try:
+                operation.postflight_cleanup()
+            except Exception:
+                logging.exception(f"Exception caught from {operation.NAME}")
+        global_limiter.configure(None)
 
-        file_path = event.src_path
-        logging.debug(f"Monitor found {file_path} for event type MODIFIED")
-        GLib.idle_add(self._appwindow.file_changes_done_cb, file_path, priority=GLib.PRIORITY_DEFAULT_IDLE)
-        
+        GLib.idle_add(self._appwindow._postflight_cleanup_cb, self._task_window, priority=GLib.PRIORITY_DEFAULT_IDLE)
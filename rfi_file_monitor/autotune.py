@@ -0,0 +1,122 @@
+import logging
+from time import monotonic
+from typing import Final, List, Optional, Sequence, Tuple
+
+# interval between two consecutive adjustments, in seconds
+AUTOTUNE_INTERVAL: Final[float] = 5.0
+# back off when more than this fraction of the operations failed during an interval
+AUTOTUNE_ERROR_RATE: Final[float] = 0.2
+# throughput is considered unchanged if it did not drop by more than this fraction
+AUTOTUNE_TOLERANCE: Final[float] = 0.1
+# factor applied to the window when backing off
+AUTOTUNE_DECREASE: Final[float] = 0.5
+
+class _StageStats:
+    __slots__ = ('window', 'slow_start', 'completed', 'failed', 'nbytes', 'elapsed', 'saturated', 'throughput')
+
+    def __init__(self):
+        self.window: int = 1
+        # the window doubles instead of growing by one until the first back-off
+        self.slow_start: bool = True
+        self.completed: int = 0
+        self.failed: int = 0
+        self.nbytes: int = 0
+        self.elapsed: float = 0.0
+        self.saturated: bool = False
+        # bytes/s during the previous interval, if it was saturated
+        self.throughput: Optional[float] = None
+
+    def reset(self):
+        self.completed = 0
+        self.failed = 0
+        self.nbytes = 0
+        self.elapsed = 0.0
+        self.saturated = False
+
+class ConcurrencyTuner:
+    """
+    Adjusts the number of files each operation may process at the same time,
+    its window, between 1 and its configured limit, using AIMD.
+
+    Every AUTOTUNE_INTERVAL seconds, the aggregate throughput in bytes/s
+    and the mean latency of the operations that finished are computed per operation.
+    Operations that had files waiting because their window was full get a larger window
+    as long as their throughput does not drop, and a window that is reduced by
+    AUTOTUNE_DECREASE if it does, or if their error rate exceeds AUTOTUNE_ERROR_RATE.
+    Windows start at one and double until the first reduction (slow start),
+    after which they grow by one per interval.
+
+    Not thread-safe: the scheduler calls it while holding its lock.
+    """
+    def __init__(self, names: Sequence[str], limits: Sequence[int], interval: float = AUTOTUNE_INTERVAL):
+        self._names: Final[Tuple[str, ...]] = tuple(names)
+        self._limits: Final[Tuple[int, ...]] = tuple(limits)
+        self._interval = interval
+        self._stats: Final[List[_StageStats]] = [_StageStats() for _ in limits]
+        self._next_adjustment = monotonic() + interval
+
+    @property
+    def windows(self) -> Tuple[int, ...]:
+        return tuple(stats.window for stats in self._stats)
+
+    def window(self, stage: int) -> int:
+        return self._stats[stage].window
+
+    def saturated(self, stage: int):
+        """
+        Files were waiting for this operation because its window was full.
+        """
+        self._stats[stage].saturated = True
+
+    def record(self, stage: int, elapsed: float, nbytes: int, success: bool):
+        stats = self._stats[stage]
+        stats.completed += 1
+        stats.failed += not success
+        stats.nbytes += nbytes
+        stats.elapsed += elapsed
+
+    def adjust(self) -> bool:
+        """
+        Adjust the windows if the interval has expired.
+        Returns True if any of them changed.
+        """
+        now = monotonic()
+        if now < self._next_adjustment:
+            return False
+        duration = now - self._next_adjustment + self._interval
+        self._next_adjustment = now + self._interval
+
+        changed = False
+        for stage, stats in enumerate(self._stats):
+            window = stats.window
+            if stats.completed == 0:
+                # nothing to learn from
+                stats.throughput = None
+                stats.reset()
+                continue
+            throughput = stats.nbytes / duration
+            error_rate = stats.failed / stats.completed
+            if error_rate > AUTOTUNE_ERROR_RATE:
+                reason = f'error rate {error_rate:.0%}'
+                window = max(int(window * AUTOTUNE_DECREASE), 1)
+                stats.slow_start = False
+            elif not stats.saturated:
+                # the window was not the bottleneck, so it does not need to grow
+                reason = None
+            elif stats.throughput is not None and throughput < stats.throughput * (1 - AUTOTUNE_TOLERANCE):
+                reason = f'throughput dropped from {stats.throughput / 1e6:.1f} MB/s'
+                window = max(int(window * AUTOTUNE_DECREASE), 1)
+                stats.slow_start = False
+            else:
+                reason = 'files are waiting'
+                window = min(window * 2 if stats.slow_start else window + 1, self._limits[stage])
+            stats.throughput = throughput if stats.saturated else None
+
+            if window != stats.window:
+                logging.info(f"ConcurrencyTuner: {self._names[stage]}: {stats.window} -> {window} ({reason}), "
+                    f"{throughput / 1e6:.1f} MB/s, {stats.elapsed / stats.completed:.2f} s per file, "
+                    f"{stats.failed}/{stats.completed} failed")
+                stats.window = window
+                changed = True
+            stats.reset()
+        return changed
@@ -0,0 +1,132 @@
+import logging
+import os
+import stat as stat_module
+from fnmatch import fnmatch
+from threading import Event, Thread
+from time import time
+from typing import Callable, Final, Iterable, Iterator, List, Optional, Sequence
+
+# number of files that are handed over at once
+BACKLOG_CHUNK_SIZE: Final[int] = 500
+# ingestion pauses while the scheduler has this many files waiting to be processed
+BACKLOG_MAX_WAITING: Final[int] = 1000
+
+class BacklogIngester(Thread):
+    """
+    Walks a directory with os.scandir in a background thread, and hands over
+    the files that existed before monitoring started to submit, in chunks.
+
+    submit is expected to block until the chunk has been registered.
+    Before every chunk, ingestion pauses until wait_for_scheduler reports that
+    fewer than BACKLOG_MAX_WAITING files are waiting to be processed, so that the
+    backlog is streamed instead of being loaded in memory at once, and so that
+    files found by the live monitor do not end up behind the entire backlog.
+
+    Files modified after ingestion started may still be being written, and are
+    handed over to submit_recent instead, right away and without pausing,
+    so that they can be registered as created: the live monitor will then report
+    them as saved. Without submit_recent, they are skipped. Files for which
+    skip returns True are skipped as well. If file_paths is provided,
+    these files are handed over instead of the contents of the directory.
+    """
+    def __init__(self,
+        path: str,
+        submit: Callable[[List[str]], None],
+        wait_for_scheduler: Callable[[int, float], bool],
+        recursive: bool = False,
+        ignore_patterns: Sequence[str] = (),
+        chunk_size: int = BACKLOG_CHUNK_SIZE,
+        skip: Optional[Callable[[str, os.stat_result], bool]] = None,
+        file_paths: Optional[Iterable[str]] = None,
+        submit_recent: Optional[Callable[[List[str]], None]] = None):
+
+        super().__init__(daemon=True)
+        self._path = path
+        self._submit = submit
+        self._wait_for_scheduler = wait_for_scheduler
+        self._recursive = recursive
+        self._ignore_patterns = tuple(ignore_patterns)
+        self._chunk_size = chunk_size
+        self._skip = skip
+        self._file_paths = file_paths
+        self._submit_recent = submit_recent
+        self._recent: List[str] = []
+        self._should_exit: Final[Event] = Event()
+        self._started_at: float = time()
+
+    def stop(self):
+        self._should_exit.set()
+
+    def run(self):
+        self._started_at = time()
+        nfiles = 0
+        chunk: List[str] = []
+        files = self._walk(self._path) if self._file_paths is None else self._filter(self._file_paths)
+        for file_path in files:
+            chunk.append(file_path)
+            if len(chunk) == self._chunk_size:
+                if not self._hand_over(chunk):
+                    return
+                nfiles += len(chunk)
+                chunk = []
+        if chunk and self._hand_over(chunk):
+            nfiles += len(chunk)
+        self._hand_over_recent()
+        logging.info(f"BacklogIngester: found {nfiles} existing files in {self._path}")
+
+    def _hand_over_recent(self):
+        if self._recent and not self._should_exit.is_set():
+            logging.debug(f"BacklogIngester: found {len(self._recent)} files that are being modified")
+            self._submit_recent(self._recent)
+        self._recent = []
+
+    def _hand_over(self, chunk: List[str]) -> bool:
+        # do not keep files that are being written waiting while the scheduler is busy
+        self._hand_over_recent()
+        while not self._should_exit.is_set():
+            if self._wait_for_scheduler(BACKLOG_MAX_WAITING, 1.0):
+                break
+        if self._should_exit.is_set():
+            return False
+        self._submit(chunk)
+        return True
+
+    def _walk(self, path: str) -> Iterator[str]:
+        stack = [path]
+        while stack and not self._should_exit.is_set():
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if self._recursive:
+                                    stack.append(entry.path)
+                            elif entry.is_file() and self._accept(entry.path, entry.name, entry.stat()):
+                                yield entry.path
+                        except OSError:
+                            continue
+            except OSError:
+                logging.warning(f"BacklogIngester: could not scan {directory}")
+
+    def _filter(self, file_paths: Iterable[str]) -> Iterator[str]:
+        for file_path in file_paths:
+            if self._should_exit.is_set():
+                return
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            if stat_module.S_ISREG(stat.st_mode) and self._accept(file_path, os.path.basename(file_path), stat):
+                yield file_path
+
+    def _accept(self, file_path: str, name: str, stat: os.stat_result) -> bool:
+        if any(fnmatch(name, pattern) for pattern in self._ignore_patterns):
+            return False
+        if stat.st_mtime >= self._started_at:
+            if self._submit_recent is not None:
+                self._recent.append(file_path)
+                if len(self._recent) == self._chunk_size:
+                    self._hand_over_recent()
+            return False
+        return self._skip is None or not self._skip(file_path, stat)
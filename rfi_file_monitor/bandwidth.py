@@ -0,0 +1,130 @@
+import logging
+from datetime import datetime, time as dtime
+from threading import Lock
+from time import monotonic, sleep
+from typing import Final, List, Optional, Tuple
+
+MB: Final[int] = 1024 * 1024
+
+# the bucket holds at most this many seconds worth of bytes, which is the largest burst allowed
+BANDWIDTH_BURST: Final[float] = 0.5
+# interval between two consecutive lookups of the current rate in the schedule, in seconds
+BANDWIDTH_SCHEDULE_INTERVAL: Final[float] = 10.0
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting a stream of bytes to rate bytes/s.
+
+    Tokens are added continuously, up to rate * BANDWIDTH_BURST. Consumers take
+    the tokens they need right away, possibly leaving the bucket in debt,
+    and then sleep until the debt they caused has been paid back.
+    A consumer therefore never waits for those arriving after it,
+    and the cost of a call does not depend on the number of consumers.
+    A rate of None means unlimited.
+    """
+    def __init__(self, rate: Optional[float] = None):
+        self._lock = Lock()
+        self._rate: Optional[float] = None
+        self._tokens: float = 0.0
+        self._last: float = monotonic()
+        self.rate = rate
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    @rate.setter
+    def rate(self, value: Optional[float]):
+        with self._lock:
+            self._rate = float(value) if value else None
+            self._tokens = 0.0
+            self._last = monotonic()
+
+    def consume(self, nbytes: int):
+        """
+        Block until nbytes may be sent.
+        """
+        if nbytes <= 0:
+            return
+        with self._lock:
+            if (rate := self._rate) is None:
+                return
+            now = monotonic()
+            self._tokens = min(self._tokens + (now - self._last) * rate, rate * BANDWIDTH_BURST) - nbytes
+            self._last = now
+            delay = -self._tokens / rate
+        if delay > 0:
+            sleep(delay)
+
+class BandwidthSchedule:
+    """
+    Time-of-day bandwidth limits, parsed from a comma separated list of entries
+    such as 08:00-18:00=10, with the limit in MB/s, and 0 meaning unlimited.
+    Ranges may wrap around midnight. At times that are not covered by
+    any of the entries, the default limit applies. If entries overlap,
+    the first one wins. A ValueError is raised if the schedule cannot be parsed.
+    """
+    def __init__(self, schedule: Optional[str], default: Optional[float] = None):
+        self._default: Final[Optional[float]] = default
+        self._entries: Final[List[Tuple[dtime, dtime, Optional[float]]]] = []
+        for entry in (schedule or '').split(','):
+            if not entry.strip():
+                continue
+            try:
+                times, limit = entry.split('=')
+                start, end = (datetime.strptime(t.strip(), '%H:%M').time() for t in times.split('-'))
+                limit = float(limit)
+            except ValueError:
+                raise ValueError(f'Invalid bandwidth schedule entry {entry.strip()}, expected HH:MM-HH:MM=MB/s')
+            if limit < 0:
+                raise ValueError(f'Invalid bandwidth schedule entry {entry.strip()}, the limit cannot be negative')
+            self._entries.append((start, end, limit * MB if limit > 0 else None))
+
+    def rate(self, now: Optional[datetime] = None) -> Optional[float]:
+        """
+        The limit at time now, in bytes/s, or None if unlimited.
+        """
+        current = (now or datetime.now()).time()
+        for start, end, rate in self._entries:
+            if (start <= current < end) if start <= end else (current >= start or current < end):
+                return rate
+        return self._default
+
+class BandwidthLimiter(TokenBucket):
+    """
+    A TokenBucket whose rate follows a BandwidthSchedule,
+    which is looked up at most every BANDWIDTH_SCHEDULE_INTERVAL seconds.
+    """
+    def __init__(self):
+        super().__init__()
+        self._schedule: Optional[BandwidthSchedule] = None
+        self._next_lookup: float = 0.0
+
+    def configure(self, schedule: Optional[BandwidthSchedule]):
+        """
+        Follow schedule from now on, or stop limiting if None.
+        """
+        self._schedule = schedule
+        self._next_lookup = monotonic() + BANDWIDTH_SCHEDULE_INTERVAL
+        self.rate = schedule.rate() if schedule is not None else None
+        logging.debug(f'BandwidthLimiter: rate set to {self.rate} bytes/s')
+
+    def consume(self, nbytes: int):
+        if (schedule := self._schedule) is not None and monotonic() >= self._next_lookup:
+            self._next_lookup = monotonic() + BANDWIDTH_SCHEDULE_INTERVAL
+            if (rate := schedule.rate()) != self.rate:
+                logging.info(f'BandwidthLimiter: rate changed from {self.rate} to {rate} bytes/s')
+                self.rate = rate
+        super().consume(nbytes)
+
+# shared by all uploads of all operations
+global_limiter: Final[BandwidthLimiter] = BandwidthLimiter()
+
+def throttle(nbytes: int, limiter: Optional[TokenBucket] = None):
+    """
+    Block until nbytes may be sent, according to limiter, if any, and the global limiter.
+    Meant to be called from the progress callbacks of the uploads, after every chunk.
+    """
+    if limiter is not None:
+        limiter.consume(nbytes)
+    global_limiter.consume(nbytes)
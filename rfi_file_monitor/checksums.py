@@ -0,0 +1,125 @@
+import hashlib
+import os
+from typing import BinaryIO, Dict, Final, List, Optional, Sequence
+
+from .file import File
+
+# size of the blocks read when computing checksums
+CHECKSUM_CHUNK_SIZE: Final[int] = 2 ** 20 # 1 MB
+
+def compute_digests(file: File, algorithms: Sequence[str]) -> Dict[str, str]:
+    """
+    Return the hex digests of file for the requested hashlib algorithms.
+    Digests are cached on the file, and all missing ones are computed
+    in a single pass, so the file is read at most once, no matter how many
+    operations need its checksums.
+    """
+    missing = [algorithm for algorithm in algorithms if algorithm not in file.digests]
+    if missing:
+        hashers = {algorithm: hashlib.new(algorithm) for algorithm in missing}
+        with open(file.filename, 'rb') as f:
+            while chunk := f.read(CHECKSUM_CHUNK_SIZE):
+                for hasher in hashers.values():
+                    hasher.update(chunk)
+        for algorithm, hasher in hashers.items():
+            file.digests[algorithm] = hasher.hexdigest()
+    return {algorithm: file.digests[algorithm] for algorithm in algorithms}
+
+def parse_algorithms(algorithms: Optional[str]) -> List[str]:
+    """
+    Split a comma separated list of hashlib algorithm names.
+    A ValueError is raised if any of them is not supported.
+    """
+    rv = [algorithm.strip().lower() for algorithm in (algorithms or '').split(',') if algorithm.strip()]
+    for algorithm in rv:
+        if algorithm not in hashlib.algorithms_available:
+            raise ValueError(f'Unsupported checksum algorithm {algorithm}')
+    return rv
+
+class HashingReader:
+    """
+    Read-only wrapper around a binary file object opened at its start,
+    which feeds the bytes that are read through it to hashers,
+    allowing checksums to be computed while uploading, without reading the file twice.
+
+    Consumers may seek back and read the same bytes again, for instance
+    when retrying a request: bytes are only hashed the first time, and in order.
+    If they skip bytes instead, or do not read the file until the end,
+    no digests are available.
+    """
+    def __init__(self, fileobj: BinaryIO, algorithms: Sequence[str]):
+        self._fileobj = fileobj
+        self._size: Final[int] = os.fstat(fileobj.fileno()).st_size
+        self._hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self._position: int = 0
+        # bytes before this offset have been hashed
+        self._hashed: int = 0
+        self._skipped: bool = False
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        start = self._position
+        self._position += len(data)
+        if start > self._hashed:
+            self._skipped = True
+        elif self._position > self._hashed and not self._skipped:
+            chunk = memoryview(data)[self._hashed - start:]
+            for hasher in self._hashers.values():
+                hasher.update(chunk)
+            self._hashed = self._position
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._position = self._fileobj.seek(offset, whence)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self):
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def digests(self) -> Optional[Dict[str, str]]:
+        """
+        The hex digests of the file, or None if it has not been read completely, in order.
+        """
+        if self._skipped or self._hashed != self._size:
+            return None
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self._hashers.items()}
+
+def hashing_reader(file: File, algorithms: Sequence[str]) -> Optional[HashingReader]:
+    """
+    Open file for computing the digests that are not cached on it yet while it is uploaded,
+    or return None if they are all known, in which case it can be uploaded as is.
+    """
+    missing = [algorithm for algorithm in algorithms if algorithm not in file.digests]
+    if not missing:
+        return None
+    return HashingReader(open(file.filename, 'rb'), missing)
+
+def store_digests(file: File, reader: Optional[HashingReader], algorithms: Sequence[str]) -> Dict[str, str]:
+    """
+    Cache the digests computed by reader on file, and return those of algorithms.
+    If reader could not compute them, they are computed by reading the file once more.
+    """
+    if reader is not None and (digests := reader.digests()) is not None:
+        file.digests.update(digests)
+    return compute_digests(file, algorithms)
+
+def checksum_metadata(digests: Dict[str, str]) -> Dict[str, str]:
+    """
+    The digests as entries of File.operation_metadata.
+    """
+    return {f'{algorithm} checksum': digest for algorithm, digest in digests.items()}
@@ -0,0 +1,78 @@
+import logging
+import os
+import sqlite3
+from threading import Lock
+from typing import Final, Optional, Sequence
+
+from .checksums import compute_digests
+from .file import File
+
+# hash used to identify the contents of files, the fastest one in hashlib on 64-bit platforms
+DEDUP_ALGORITHM: Final[str] = 'blake2b'
+
+_SCHEMA: Final[str] = """
+CREATE TABLE IF NOT EXISTS contents (
+    destination TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    location TEXT NOT NULL,
+    PRIMARY KEY (destination, digest, size)
+);
+CREATE INDEX IF NOT EXISTS contents_location ON contents (destination, location);
+"""
+
+class DedupCache:
+    """
+    Local content-addressed cache, stored in an SQLite database,
+    that remembers where files with a given hash and size were uploaded to.
+    Destinations identify the remote servers, locations the objects or
+    files on them. Uploading other contents to a location forgets
+    what was previously stored there.
+
+    The cache cannot know about remote changes made by others, so operations
+    should verify that a location still exists, and discard it otherwise.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(_SCHEMA)
+
+    @staticmethod
+    def digest(file: File, algorithms: Sequence[str] = ()) -> str:
+        """
+        The digest identifying the contents of file. The digests of algorithms
+        are computed in the same pass, and cached on file.
+        """
+        return compute_digests(file, (DEDUP_ALGORITHM, *algorithms))[DEDUP_ALGORITHM]
+
+    def lookup(self, destination: str, digest: str, size: int) -> Optional[str]:
+        """
+        The location on destination of the contents identified by digest and size, or None.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT location FROM contents WHERE destination = ? AND digest = ? AND size = ?',
+                (destination, digest, size)).fetchone()
+        return row[0] if row else None
+
+    def add(self, destination: str, digest: str, size: int, location: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM contents WHERE destination = ? AND location = ?',
+                (destination, location))
+            self._connection.execute(
+                'INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?)',
+                (destination, digest, size, location))
+
+    def discard(self, destination: str, location: str):
+        logging.debug(f"DedupCache: discarding {location} on {destination}")
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM contents WHERE destination = ? AND location = ?',
+                (destination, location))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -4,8 +4,16 @@ gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
 
 import logging
+import sys
 from pathlib import PurePath
-from typing import Final, Dict, Any
+from threading import Lock
+from typing import Final, Dict, Any, Optional
+
+# interval between two consecutive flushes of the progress updates, in ms
+PROGRESS_UPDATE_INTERVAL: Final[int] = 100
+
+# guards the lazy creation of the dicts of all files, which happens once per file at most
+_lazy_attribute_lock: Final[Lock] = Lock()
 
 @unique
 class FileStatus(IntEnum):
@@ -22,31 +30,64 @@ class FileStatus(IntEnum):
         return self.name.lower().capitalize().replace('_', ' ')
 
 class File:
+    """
+    A file that is being tracked by the monitor.
+
+    As millions of instances may be alive during long runs, files use __slots__,
+    share the string of their monitored root with all other files in it,
+    create their relative filename on demand, and only allocate their
+    metadata and digests dicts when they are accessed for the first time.
+    """
+    __slots__ = ('_filename', '_root', '_created', '_status', '_row_reference', '_operation_metadata', '_digests')
+
     def __init__(self, \
         filename: str, \
-        relative_filename: PurePath, \
+        relative_filename: Optional[PurePath], \
         created: int, \
         status: FileStatus, \
-        row_reference: Gtk.TreeRowReference):
+        row_reference: Optional[Gtk.TreeRowReference]):
 
         self._filename = filename
-        self._relative_filename = relative_filename
+        if relative_filename is None:
+            self._root = None
+        else:
+            # the part of filename before relative_filename, interned so all files share it
+            self._root = sys.intern(filename[:len(filename) - len(str(relative_filename))])
         self._created = created
+        # enum members are singletons: this costs a reference, not an object
         self._status = status
         self._row_reference = row_reference
-        self._operation_metadata : Final[Dict[int, Dict[str, Any]]] = dict()
+        self._operation_metadata : Optional[Dict[int, Dict[str, Any]]] = None
+        self._digests : Optional[Dict[str, str]] = None
 
     @property
     def operation_metadata(self) -> Dict[int, Dict[str, Any]]:
+        if self._operation_metadata is None:
+            with _lazy_attribute_lock:
+                if self._operation_metadata is None:
+                    self._operation_metadata = dict()
         return self._operation_metadata
 
+    @property
+    def digests(self) -> Dict[str, str]:
+        """
+        Checksums of the file contents, keyed by hashlib algorithm name.
+        """
+        if self._digests is None:
+            with _lazy_attribute_lock:
+                if self._digests is None:
+                    self._digests = dict()
+        return self._digests
+
     @property
     def filename(self) -> str:
         return self._filename
 
     @property
-    def relative_filename(self) -> PurePath:
-        return self._relative_filename
+    def relative_filename(self) -> Optional[PurePath]:
+        if self._root is None:
+            return None
+        return PurePath(self._filename[len(self._root):])
 
     @property
     def created(self) -> int:
@@ -64,27 +105,31 @@ class File:
     def row_reference(self):
         return self._row_reference
 
-    def _update_progressbar_worker_cb(self, index: int, value: float):
-        #logging.debug(f"_update_progressbar_worker_cb: {index=} {value=}")
+    def _update_progressbar_worker_cb(self, updates: Dict[int, float]):
+        #logging.debug(f"_update_progressbar_worker_cb: {updates=}")
         if not self.row_reference.valid():
             logging.warning(f"_update_progressbar_worker_cb: {self.filename} is invalid!")
-            return GLib.SOURCE_REMOVE
+            return
 
         model = self.row_reference.get_model()
         path = self.row_reference.get_path()
         parent_iter = model.get_iter(path)
-        n_children = model.iter_n_children(parent_iter)
 
-        cumul_value = (index * 100.0 + value) / n_children
+        for index, value in updates.items():
+            child_iter = model.iter_nth_child(parent_iter, index)
+            # ignore updates that arrived after the operation finished
+            if model[child_iter][2] in (FileStatus.SUCCESS, FileStatus.FAILURE):
+                continue
+            model[child_iter][4] = value
+            model[child_iter][5] = f"{value:.1f} %"
+
+        # operations may run concurrently: use the average of their progress
+        children = model[parent_iter].iterchildren()
+        n_children = model.iter_n_children(parent_iter)
+        cumul_value = sum(child[4] for child in children) / n_children
         model[parent_iter][4] = cumul_value
         model[parent_iter][5] = f"{cumul_value:.1f} %"
 
-        child_iter = model.iter_nth_child(parent_iter, index)
-        model[child_iter][4] = value
-        model[child_iter][5] = f"{value:.1f} %"
-        
-        return GLib.SOURCE_REMOVE
-
     def _update_status_worker_cb(self, index: int, status: FileStatus):
         if not self.row_reference.valid():
             logging.warning(f"_update_status_worker_cb: {self.filename} is invalid!")
@@ -94,10 +139,7 @@ class File:
         path = self.row_reference.get_path()
         iter = model.get_iter(path)
 
-        if index == -1: # parent
-            self.status = int(status)
-            iter = model.get_iter(path)
-        else:
+        if index != -1: # child
             iter = model.iter_nth_child(iter, index)
 
         model[iter][2] = int(status)
@@ -116,7 +158,13 @@ class File:
         When an operation has finished, update the status of the corresponding
         entry in the treemodel.
         An index of -1 refers to the parent entry, 0 or higher refers to a child.
+        The status of the parent is updated immediately, the treemodel asynchronously.
+        Files without row_reference are not shown in a treemodel.
         """
+        if index == -1:
+            self._status = status
+        if self._row_reference is None:
+            return
         GLib.idle_add(self._update_status_worker_cb, index, status)
 
     def update_progressbar(self, index: int, value: float):
@@ -125,8 +173,40 @@ class File:
         defined by index, as well as the global one.
         value must be between 0 and 100.
 
-        Try not to use this function too often, as it may slow the GUI
-        down considerably. I recommend to use it only when value is a whole number
+        Updates are coalesced and applied to the GUI at most 10 times per second,
+        but it is still recommended to use it only when value is a whole number.
         """
-        GLib.idle_add(self._update_progressbar_worker_cb, index, value)
+        if self._row_reference is not None:
+            _progress_aggregator.update(self, index, value)
+
+class ProgressAggregator:
+    """
+    Collects the progress updates of all files from the worker threads,
+    keeping only the latest value per operation, and applies them
+    in a single batch from the GUI thread, at a limited rate.
+    """
+    def __init__(self, interval: int = PROGRESS_UPDATE_INTERVAL):
+        self._interval = interval
+        self._lock = Lock()
+        self._pending: Dict[File, Dict[int, float]] = dict()
+        self._flush_scheduled: bool = False
+
+    def update(self, file: File, index: int, value: float):
+        with self._lock:
+            self._pending.setdefault(file, dict())[index] = value
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        GLib.timeout_add(self._interval, self._flush_cb, priority=GLib.PRIORITY_DEFAULT_IDLE)
+
+    def _flush_cb(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = dict()
+            self._flush_scheduled = False
+        for file, updates in pending.items():
+            file._update_progressbar_worker_cb(updates)
+        return GLib.SOURCE_REMOVE
+
+_progress_aggregator: Final[ProgressAggregator] = ProgressAggregator()
 
@@ -0,0 +1,306 @@
+import yaml
+
+import argparse
+import importlib.metadata
+import logging
+import platform
+import signal
+import sys
+from pathlib import PurePath
+from threading import Event, RLock, Thread
+from time import time
+from typing import Any, Dict, Final, List, Optional
+
+from .backlog import BacklogIngester
+from .file import File, FileStatus
+from .journal import Journal, configuration_id
+from .monitor import DirectoryMonitor, EventHandler, IGNORE_PATTERNS
+from .operation import Operation
+from .quiescence import QuiescenceDetector
+from .scheduler import Scheduler, resolve_dependencies, DEFAULT_JOBS
+from .retention import FileHistory, FileRetention, RETENTION_INTERVAL
+from .priority import queue_policy
+from .bandwidth import BandwidthSchedule, global_limiter, MB
+from .utils import JOURNAL_FILE, HISTORY_FILE
+
+# used for the options that are missing from the configuration, matching the GUI
+DEFAULT_CONFIGURATION: Final[Dict[str, Any]] = dict(
+    status_promotion_active=False,
+    status_promotion_delay=5,
+    max_threads=DEFAULT_JOBS,
+    autotune_active=False,
+    pipeline_operations=False,
+    save_detection='modified',
+    quiescence_period=5,
+    monitor_recursively=False,
+    process_existing_files=False,
+    journal_active=False,
+    retention_max_rows_active=False,
+    retention_max_rows=10000,
+    retention_max_age_active=False,
+    retention_max_age=60,
+    retention_archive=False,
+    queue_policy='fifo',
+    queue_priority_patterns=None,
+    bandwidth_limit_active=False,
+    bandwidth_limit=100,
+    bandwidth_schedule=None,
+)
+
+class HeadlessMonitor:
+    """
+    Runs a configuration saved by the ApplicationWindow, without a GUI.
+
+    The operations are created from their saved parameters without building
+    any widgets, and files are tracked without a treemodel. Events are handled
+    directly in the threads they arrive in, instead of on the GLib main loop.
+    """
+    def __init__(self, yaml_dict: Dict[str, Any]):
+        self._configuration: Final[Dict[str, Any]] = {**DEFAULT_CONFIGURATION, **yaml_dict['configuration']}
+        if not self._configuration.get('monitored_directory'):
+            raise ValueError('No monitored_directory found in configuration')
+
+        known_operations = {
+            _class.NAME: _class for _class in (e.load() for e in importlib.metadata.entry_points()['rfi_file_monitor.operations'])
+        }
+        self._operations: Final[List[Operation]] = []
+        for op in yaml_dict['operations']:
+            if op['name'] not in known_operations:
+                raise ValueError(f"Unknown operation {op['name']}")
+            self._operations.append(known_operations[op['name']].from_params(
+                op['params'], index=len(self._operations), depends_on=op.get('depends_on')))
+        if not self._operations:
+            raise ValueError('No operations found in configuration')
+
+        self._files_dict_lock = RLock()
+        self._files_dict: Final[Dict[str, File]] = dict()
+        self._scheduler: Optional[Scheduler] = None
+        self._journal: Optional[Journal] = None
+        self._quiescence_detector: Optional[QuiescenceDetector] = None
+        self._event_handler: Optional[EventHandler] = None
+        self._monitor: Optional[DirectoryMonitor] = None
+        self._backlog_ingester: Optional[BacklogIngester] = None
+        self._retention: Optional[FileRetention] = None
+        self._retention_thread: Optional[Thread] = None
+        self._should_exit: Final[Event] = Event()
+
+    @property
+    def configuration(self) -> Dict[str, Any]:
+        return self._configuration
+
+    def _preflight_check(self) -> Optional[Journal]:
+        exception_msgs = []
+        for operation in self._operations:
+            try:
+                operation.preflight_check()
+            except Exception as e:
+                logging.exception(f"Exception caught from {operation.NAME}")
+                exception_msgs.append('* ' + str(e))
+
+        try:
+            resolve_dependencies(self._operations)
+        except ValueError as e:
+            exception_msgs.append('* ' + str(e))
+
+        if self._configuration['save_detection'] == 'closed' and platform.system() != 'Linux':
+            exception_msgs.append('* Detecting files that are closed after writing is only supported on Linux')
+
+        if self._configuration['bandwidth_limit_active']:
+            try:
+                global_limiter.configure(BandwidthSchedule(self._configuration['bandwidth_schedule'], self._configuration['bandwidth_limit'] * MB))
+            except ValueError as e:
+                exception_msgs.append('* ' + str(e))
+
+        journal = None
+        if not exception_msgs and self._configuration['journal_active']:
+            try:
+                journal = Journal(str(JOURNAL_FILE), configuration_id(self._operations))
+            except Exception as e:
+                logging.exception(f"Could not open journal {JOURNAL_FILE}")
+                exception_msgs.append(f'* Could not open journal {JOURNAL_FILE}: {e}')
+
+        if exception_msgs:
+            for operation in self._operations:
+                operation.postflight_cleanup()
+            global_limiter.configure(None)
+            raise RuntimeError('Operation configuration error(s) found\n' + '\n'.join(exception_msgs))
+
+        return journal
+
+    def start(self):
+        """
+        Run the preflight checks, and start monitoring.
+        A RuntimeError is raised if the preflight checks failed.
+        """
+        conf = self._configuration
+        journal = self._preflight_check()
+        self._journal = journal
+        if journal is not None:
+            journal.start()
+        if conf['retention_max_rows_active'] or conf['retention_max_age_active']:
+            self._retention = FileRetention(
+                max_rows=int(conf['retention_max_rows']) if conf['retention_max_rows_active'] else None,
+                max_age=conf['retention_max_age'] * 60 if conf['retention_max_age_active'] else None,
+                history=FileHistory(str(HISTORY_FILE)) if conf['retention_archive'] else None,
+            )
+            self._retention_thread = Thread(target=self._retention_worker, daemon=True)
+            self._retention_thread.start()
+        self._scheduler = Scheduler(
+            operations=self._operations,
+            max_threads=conf['max_threads'],
+            promotion_delay=conf['status_promotion_delay'] if conf['status_promotion_active'] else None,
+            pipeline=conf['pipeline_operations'],
+            journal=journal,
+            file_done_cb=self._retention.file_done if self._retention is not None else None,
+            autotune=conf['autotune_active'],
+            queue_policy=queue_policy(conf['queue_policy'], conf['queue_priority_patterns']),
+        )
+        self._scheduler.start()
+
+        if conf['save_detection'] == 'quiescent':
+            self._quiescence_detector = QuiescenceDetector(
+                period=conf['quiescence_period'],
+                callback=self.file_changes_done_cb,
+                path=conf['monitored_directory'],
+                created_cb=self.file_created_cb,
+                recursive=conf['monitor_recursively'],
+                ignore_patterns=IGNORE_PATTERNS,
+            )
+            self._quiescence_detector.start()
+
+        self._event_handler = EventHandler(self, conf['save_detection'], dispatch=self._dispatch)
+        self._monitor = DirectoryMonitor(self._event_handler, conf['monitored_directory'], recursive=conf['monitor_recursively'])
+        self._monitor.start()
+
+        if conf['process_existing_files'] or (journal is not None and journal.interrupted):
+            self._backlog_ingester = BacklogIngester(
+                path=conf['monitored_directory'],
+                submit=self.existing_files_cb,
+                wait_for_scheduler=self._scheduler.wait_for_nwaiting,
+                recursive=conf['monitor_recursively'],
+                ignore_patterns=IGNORE_PATTERNS,
+                skip=journal.is_completed if journal is not None else None,
+                file_paths=None if conf['process_existing_files'] else journal.interrupted,
+                submit_recent=self.recent_files_cb,
+            )
+            self._backlog_ingester.start()
+        logging.info(f"Monitoring {conf['monitored_directory']}")
+
+    def stop(self):
+        self._should_exit.set()
+        self._monitor.stop()
+        if self._backlog_ingester is not None:
+            self._backlog_ingester.stop()
+        self._event_handler.stop()
+        if self._quiescence_detector is not None:
+            self._quiescence_detector.stop()
+        with self._files_dict_lock:
+            scheduler = self._scheduler
+            scheduler.stop()
+            self._scheduler = None
+        scheduler.join()
+        if self._journal is not None:
+            self._journal.stop()
+        if self._retention is not None:
+            self._retention_thread.join()
+            self._retention.close()
+        for operation in self._operations:
+            operation.postflight_cleanup()
+        global_limiter.configure(None)
+        with self._files_dict_lock:
+            self._files_dict.clear()
+        logging.info(f"Stopped monitoring {self._configuration['monitored_directory']}")
+
+    def _retention_worker(self):
+        while not self._should_exit.wait(RETENTION_INTERVAL):
+            with self._files_dict_lock:
+                self._retention.evict(self._files_dict)
+
+    @staticmethod
+    def _dispatch(callback, *args, **kwargs):
+        # no main loop to defer to: call right away, ignoring the GLib priority
+        callback(*args)
+
+    def _add_file(self, file_path: str) -> File:
+        # must be called while holding the files dict lock
+        _relative_file_path = PurePath(file_path).relative_to(self._configuration['monitored_directory'])
+        _file = File(filename=file_path, relative_filename=_relative_file_path, created=time(), status=FileStatus.CREATED, row_reference=None)
+        self._files_dict[file_path] = _file
+        return _file
+
+    def file_created_cb(self, file_path: str):
+        with self._files_dict_lock:
+            if self._scheduler is None:
+                # monitor has been stopped already
+                pass
+            elif file_path in self._files_dict and self._files_dict[file_path].status == FileStatus.CREATED:
+                # found by the BacklogIngester while it was being written
+                logging.debug(f"{file_path} has been created already")
+            elif file_path in self._files_dict:
+                logging.warning(f"{file_path} has been recreated! Ignoring...")
+            else:
+                logging.debug(f"New file {file_path} created")
+                _file = self._add_file(file_path)
+                self._scheduler.file_created(_file)
+
+    def file_changes_done_cb(self, file_path: str):
+        with self._files_dict_lock:
+            if self._scheduler is None:
+                # monitor has been stopped already
+                pass
+            elif file_path not in self._files_dict:
+                logging.warning(f"{file_path} has not been created yet! Ignoring...")
+            elif self._files_dict[file_path].status != FileStatus.CREATED:
+                # looks like this file has been saved again!
+                logging.warning(f"{file_path} has been saved again?? Ignoring!")
+            else:
+                logging.debug(f"File {file_path} has been saved")
+                self._scheduler.file_saved(self._files_dict[file_path])
+
+    def recent_files_cb(self, file_paths: List[str]):
+        with self._files_dict_lock:
+            if self._scheduler is None:
+                return
+            for file_path in file_paths:
+                if file_path in self._files_dict:
+                    continue
+                self._scheduler.file_created(self._add_file(file_path))
+                if self._quiescence_detector is not None:
+                    self._quiescence_detector.add(file_path)
+
+    def existing_files_cb(self, file_paths: List[str]):
+        with self._files_dict_lock:
+            if self._scheduler is None:
+                return
+            for file_path in file_paths:
+                if file_path in self._files_dict:
+                    continue
+                self._scheduler.file_saved(self._add_file(file_path))
+
+# headless entrypoint
+def main():
+    parser = argparse.ArgumentParser(description='Run a saved RFI File Monitor configuration without GUI')
+    parser.add_argument('configuration', help='YAML configuration file, as saved by the GUI')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    with open(args.configuration) as f:
+        yaml_dict = yaml.safe_load(f)
+
+    try:
+        monitor = HeadlessMonitor(yaml_dict)
+        monitor.start()
+    except (ValueError, RuntimeError) as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    should_exit = Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: should_exit.set())
+    while not should_exit.wait(1.0):
+        pass
+
+    monitor.stop()
+    logging.info('Finished')
@@ -1,46 +1,180 @@
+import logging
+import os
+from concurrent.futures import Future
+from queue import Empty, SimpleQueue
 import threading
-from typing import Final
+from time import monotonic
+from typing import Final, List, Optional
 
 from .file import File, FileStatus
 
-class Job(threading.Thread):
-    def __init__(self, appwindow, file: File):
-        super().__init__()
-        self._appwindow = appwindow 
+class Job:
+    """
+    Keeps track of the operations that need to be run on a single file.
+
+    Operations form a dependency graph: by default every operation depends
+    on the one before it, but the configuration may declare other dependencies,
+    allowing independent operations to run concurrently.
+    An operation only runs when all of its dependencies succeeded,
+    and is marked as failed as soon as one of them fails.
+    Each call to run() executes a single operation, after which the scheduler
+    is notified and it will launch the operations that became ready.
+    Jobs with a smaller priority key are launched first, see QueuePolicy.
+    """
+    def __init__(self, scheduler, file: File, priority: float = 0.0):
+        self._scheduler = scheduler
         self._file = file
+        self._priority: Final[float] = priority
         self._should_exit: Final[bool] = False
+        noperations = len(scheduler.operations)
+        # If operation.run() returns None, then it was considered a success.
+        #Otherwise a string is returned with an error message
+        self._results: Final[List[Optional[str]]] = [None] * noperations
+        self._done: Final[List[bool]] = [False] * noperations
+        self._npending: int = noperations
+        self._started: bool = False
+        # only looked up for the tuner, once
+        self._size: Optional[int] = None
 
-    def run(self):
+    def run(self, index: int):
+        started = monotonic()
+        deferred = None
+        try:
+            deferred = self._run_operation(index, self._scheduler.operations[index])
+        finally:
+            if deferred is None:
+                self._scheduler.job_done(self, index, monotonic() - started, self._nbytes())
+            else:
+                # the operation finishes in another thread: only release the worker for now
+                self._scheduler.job_deferred(self, index)
+                deferred.add_done_callback(lambda future: self._deferred_done(index, future, started))
+
+    def _nbytes(self) -> int:
+        if not self._scheduler.autotune:
+            return 0
+        if self._size is None:
+            try:
+                self._size = os.path.getsize(self._file.filename)
+            except OSError:
+                self._size = 0
+        return self._size
+
+    def _run_operation(self, index: int, operation) -> Optional[Future]:
+        self._file.update_status(index, FileStatus.RUNNING)
+
+        if self._should_exit:
+            result = 'Job aborted'
+        else:
+            try:
+                result = operation.run(self._file)
+            except Exception as e:
+                # an operation that raises has failed, as if it returned an error message
+                logging.exception(f"Job: uncaught exception in {operation.NAME} for {self._file.filename}")
+                result = str(e) or type(e).__name__
+
+        if isinstance(result, Future):
+            return result
+        self._set_result(index, result)
+        return None
+
+    def _deferred_done(self, index: int, future: Future, started: float):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = str(e)
+        self._set_result(index, result)
+        self._scheduler.job_done(self, index, monotonic() - started, self._nbytes(), deferred=True)
+
+    def _set_result(self, index: int, result: Optional[str]):
+        self._results[index] = result
+
+        if self._results[index] is None:
+            # update operation status to success
+            self._file.update_status(index, FileStatus.SUCCESS)
+        else:
+            # update operation status to failed
+            self._file.update_status(index, FileStatus.FAILURE)
+
+    def start(self):
+        """
+        Called by the scheduler when the first operation is launched.
+        """
+        self._started = True
         # update status to running
         self._file.update_status(-1, FileStatus.RUNNING)
 
-        # If operation.run() returns None, then it was considered a success.
-        #Otherwise a string is returned with an error message
-        rv = None
+    def complete(self, index: int) -> List[int]:
+        """
+        Called by the scheduler when operation index has finished running.
+        Returns the operations that are now ready to be launched.
+        """
+        ready = []
+        self._mark_done(index)
 
-        for index, operation in enumerate(self._appwindow._operations_box):
-            self._file.update_status(index, FileStatus.RUNNING)
+        for dependent in self._scheduler.dependents[index]:
+            if self._done[dependent]:
+                continue
+            if self._results[index] is not None:
+                self._skip(dependent)
+            elif all(self._done[dep] and self._results[dep] is None for dep in self._scheduler.dependencies[dependent]):
+                ready.append(dependent)
 
-            if not self._should_exit and \
-                rv is None and \
-                (rv := operation.run(self._file)) is None:
-                # update operation status to success
-                self._file.update_status(index, FileStatus.SUCCESS)
-            else:
-                # update operation status to failed
-                self._file.update_status(index, FileStatus.FAILURE)
+        return ready
+
+    def _skip(self, index: int):
+        # a dependency failed: this operation and those depending on it will not run
+        self._results[index] = 'Dependency failed'
+        self._file.update_status(index, FileStatus.FAILURE)
+        self._mark_done(index)
+        for dependent in self._scheduler.dependents[index]:
+            if not self._done[dependent]:
+                self._skip(dependent)
+
+    def _mark_done(self, index: int):
+        self._done[index] = True
+        self._npending -= 1
+        if self._npending > 0:
+            return
 
         # update global operation status
-        if rv is None:
+        if self.error is None:
             # update job status to success
             self._file.update_status(-1, FileStatus.SUCCESS)
         else:
             # update job status to failed
             self._file.update_status(-1, FileStatus.FAILURE)
 
-        self._appwindow._njobs_running -= 1
+    def succeeded(self, index: int) -> bool:
+        """
+        True if operation index has run successfully.
+        """
+        return self._done[index] and self._results[index] is None
 
-        return
+    @property
+    def priority(self) -> float:
+        return self._priority
+
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    @property
+    def done(self) -> bool:
+        """
+        True when all operations have either run or have been skipped.
+        """
+        return self._npending == 0
+
+    @property
+    def error(self) -> Optional[str]:
+        """
+        The error message of the first failed operation, or None.
+        """
+        return next((rv for rv in self._results if rv is not None), None)
+
+    @property
+    def file(self) -> File:
+        return self._file
 
     @property
     def should_exit(self):
@@ -50,3 +184,88 @@ class Job(threading.Thread):
     def should_exit(self, value: bool):
         self._should_exit = value
 
+class Worker(threading.Thread):
+    """
+    A persistent thread of a WorkerPool, running job operations one after the other.
+    Operations can check its should_exit property through threading.current_thread()
+    to find out if the job they are running should be aborted.
+    """
+    def __init__(self, pool: 'WorkerPool'):
+        super().__init__(daemon=True)
+        self._pool = pool
+        self._job: Optional[Job] = None
+
+    def run(self):
+        while (task := self._pool._queue.get()) is not None:
+            job, index = task
+            self._job = job
+            try:
+                job.run(index)
+            except Exception:
+                logging.exception(f"Worker {self.name}: uncaught exception in job for {job.file.filename}")
+            finally:
+                self._job = None
+                self._pool._job_finished()
+
+    @property
+    def should_exit(self) -> bool:
+        job = self._job
+        return job is not None and job.should_exit
+
+class WorkerPool:
+    """
+    A fixed number of persistent worker threads that pull job operations from a shared queue.
+    """
+    def __init__(self, nworkers: int):
+        self._queue: Final[SimpleQueue] = SimpleQueue()
+        self._lock = threading.Lock()
+        self._in_flight: int = 0
+        self._workers: Final[List[Worker]] = [Worker(self) for _ in range(max(int(nworkers), 1))]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, job: Job, index: int):
+        """
+        Schedule operation index of job for running.
+        """
+        with self._lock:
+            self._in_flight += 1
+        self._queue.put((job, index))
+
+    def _job_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    @property
+    def in_flight(self) -> int:
+        """
+        The number of operations that were submitted but have not finished yet.
+        """
+        with self._lock:
+            return self._in_flight
+
+    def shutdown(self, wait: bool = False):
+        """
+        Discard all operations that have not started yet, and let the workers exit
+        after finishing their current one.
+        """
+        try:
+            while True:
+                self._queue.get_nowait()
+                self._job_finished()
+        except Empty:
+            pass
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            self.join()
+
+    def join(self):
+        """
+        Wait until all workers have exited, after shutdown.
+        """
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join()
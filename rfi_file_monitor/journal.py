@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from threading import Condition, Thread
+from time import time
+from typing import Any, Dict, Final, List, Optional, Sequence, Tuple
+import yaml
+
+from .file import File, FileStatus
+from .operation import Operation
+
+# maximum time between two consecutive commits, in seconds
+JOURNAL_COMMIT_INTERVAL: Final[float] = 1.0
+# commit earlier once this many records are pending
+JOURNAL_BATCH_SIZE: Final[int] = 1000
+
+_SCHEMA: Final[str] = """
+CREATE TABLE IF NOT EXISTS files (
+    configuration TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    updated REAL NOT NULL,
+    PRIMARY KEY (configuration, filename)
+);
+CREATE TABLE IF NOT EXISTS operations (
+    configuration TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    operation INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    metadata TEXT,
+    PRIMARY KEY (configuration, filename, operation)
+);
+"""
+
+def configuration_id(operations: Sequence[Operation]) -> str:
+    """
+    Identifies the operations and their parameters in the journal.
+    """
+    dump = yaml.safe_dump([operation.to_dict() for operation in operations], sort_keys=True)
+    return hashlib.sha256(dump.encode('utf-8')).hexdigest()
+
+# (filename, operation index or -1 for the file itself, status, metadata)
+_Record = Tuple[str, int, FileStatus, Optional[Dict[str, Any]]]
+
+class Journal(Thread):
+    """
+    Durable record of the files that went through the monitor,
+    stored in an SQLite database in WAL mode.
+
+    For every file the status, and the size and modification time at the moment
+    it was saved are kept, and for every operation that ran its status and
+    operation_metadata. Rows are keyed by configuration, an identifier of the
+    operations and their parameters, so that changing the configuration
+    causes files to be processed again.
+
+    The record methods only append to a list, the database is written to
+    from this thread, which commits the pending records in batches,
+    at least every JOURNAL_COMMIT_INTERVAL seconds.
+    Files that were journaled but never finished are reported as interrupted
+    when the journal is opened again.
+    """
+    def __init__(self, path: str, configuration: str):
+        super().__init__(daemon=True)
+        self._path = path
+        self._configuration = configuration
+        self._cond = Condition()
+        self._pending: List[_Record] = []
+        self._should_exit: bool = False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(_SCHEMA)
+
+        # filename -> (size, mtime_ns) of the files that were processed successfully
+        self._completed: Final[Dict[str, Tuple[int, int]]] = dict()
+        self._interrupted: Final[List[str]] = []
+        for filename, status, size, mtime_ns in self._connection.execute(
+            'SELECT filename, status, size, mtime_ns FROM files WHERE configuration = ?', (configuration,)):
+            if status == FileStatus.SUCCESS:
+                self._completed[filename] = (size, mtime_ns)
+            elif status != FileStatus.FAILURE:
+                self._interrupted.append(filename)
+        logging.info(f"Journal: {len(self._completed)} completed and {len(self._interrupted)} interrupted files found in {path}")
+
+    @property
+    def interrupted(self) -> List[str]:
+        """
+        The files that were saved, but whose processing never finished.
+        """
+        return self._interrupted
+
+    def is_completed(self, filename: str, stat: os.stat_result) -> bool:
+        """
+        True if filename was processed successfully before, and has not changed since.
+        """
+        return self._completed.get(filename) == (stat.st_size, stat.st_mtime_ns)
+
+    def file_saved(self, file: File):
+        self._append((file.filename, -1, FileStatus.SAVED, None))
+
+    def file_done(self, file: File, status: FileStatus):
+        self._append((file.filename, -1, status, None))
+
+    def operation_done(self, file: File, index: int, status: FileStatus):
+        self._append((file.filename, index, status, file.operation_metadata.get(index)))
+
+    def _append(self, record: _Record):
+        with self._cond:
+            if self._should_exit:
+                return
+            self._pending.append(record)
+            if len(self._pending) == JOURNAL_BATCH_SIZE:
+                self._cond.notify()
+
+    def stop(self):
+        """
+        Commit the pending records and close the database.
+        """
+        with self._cond:
+            self._should_exit = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+        self._connection.close()
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._should_exit and len(self._pending) < JOURNAL_BATCH_SIZE:
+                    self._cond.wait(JOURNAL_COMMIT_INTERVAL)
+                pending = self._pending
+                self._pending = []
+                should_exit = self._should_exit
+            if pending:
+                try:
+                    self._commit(pending)
+                except sqlite3.Error:
+                    logging.exception(f"Journal: could not commit {len(pending)} records to {self._path}")
+            if should_exit:
+                return
+
+    def _commit(self, pending: List[_Record]):
+        now = time()
+        with self._connection:
+            for filename, index, status, metadata in pending:
+                if index == -1 and status == FileStatus.SAVED:
+                    try:
+                        stat = os.stat(filename)
+                        size, mtime_ns = stat.st_size, stat.st_mtime_ns
+                    except OSError:
+                        size, mtime_ns = None, None
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                        (self._configuration, filename, int(status), size, mtime_ns, now))
+                    self._connection.execute(
+                        'DELETE FROM operations WHERE configuration = ? AND filename = ?',
+                        (self._configuration, filename))
+                elif index == -1:
+                    self._connection.execute(
+                        'UPDATE files SET status = ?, updated = ? WHERE configuration = ? AND filename = ?',
+                        (int(status), now, self._configuration, filename))
+                else:
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO operations VALUES (?, ?, ?, ?, ?)',
+                        (self._configuration, filename, index, int(status),
+                        json.dumps(metadata, default=str) if metadata else None))
@@ -0,0 +1,321 @@
+from gi.repository import GLib
+from watchdog.events import DirCreatedEvent, FileClosedEvent, FileCreatedEvent, FileModifiedEvent, FileSystemEvent, FileSystemEventHandler, PatternMatchingEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+import logging
+import os
+import platform
+from fnmatch import fnmatch
+from collections import OrderedDict
+from threading import Condition, RLock, Thread
+from time import time
+from typing import OrderedDict as OrderedDictType
+from typing import Any, Callable, Dict, Final, List, Optional
+
+# a file is considered saved once it has not been modified for this many seconds
+MODIFIED_DEBOUNCE_WINDOW: Final[float] = 0.5
+# interval between two consecutive scans of the polled subtrees, in seconds
+POLLING_INTERVAL: Final[float] = 1.0
+
+IGNORE_PATTERNS: Final[List[str]] = ['*.swp', '*.swx']
+
+# fraction of the inotify limits that may be used by a single monitor,
+# leaving room for other applications and monitors
+INOTIFY_BUDGET_FRACTION: Final[float] = 0.5
+# upper bound on the number of inotify instances, each watched subtree gets its own
+MAX_INOTIFY_INSTANCES: Final[int] = 32
+
+# how a directory and its descendants are being monitored
+NATIVE_RECURSIVE: Final[str] = 'native recursive'
+NATIVE_FLAT: Final[str] = 'native flat'
+POLLING: Final[str] = 'polling'
+
+def _read_inotify_limit(name: str) -> Optional[int]:
+    try:
+        with open(f'/proc/sys/fs/inotify/{name}') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def count_directories(path: str, limit: int) -> int:
+    """
+    Count path and the directories below it with os.scandir,
+    giving up as soon as the count exceeds limit.
+    """
+    count = 0
+    stack = [path]
+    while stack and count <= limit:
+        directory = stack.pop()
+        count += 1
+        try:
+            with os.scandir(directory) as entries:
+                stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        except OSError:
+            pass
+    return count
+
+class _Dispatcher(FileSystemEventHandler):
+    def __init__(self, monitor: 'DirectoryMonitor', polling: bool = False):
+        super().__init__()
+        self._monitor = monitor
+        self._polling = polling
+
+    def dispatch(self, event: FileSystemEvent):
+        if isinstance(event, DirCreatedEvent):
+            self._monitor._directory_created(event.src_path)
+        handler = self._monitor._handler
+        if self._polling and isinstance(handler, EventHandler):
+            handler.dispatch_polled(event)
+        else:
+            handler.dispatch(event)
+
+class DirectoryMonitor:
+    """
+    Watches a directory, optionally including its subdirectories, forwarding
+    all events to handler.
+
+    Recursive monitoring on Linux is subject to the inotify limits:
+    every directory costs a watch (fs.inotify.max_user_watches), and every watched
+    subtree an instance (fs.inotify.max_user_instances). Therefore the tree is
+    divided into subtrees that are watched natively as long as they fit within
+    the budget, while the subtrees that do not fit are polled with os.scandir instead.
+    The division is done in a background thread, and extended lazily when new
+    subdirectories appear. On other platforms, recursive monitoring does not
+    require per-directory watches, and the whole tree is watched natively.
+    """
+    def __init__(self, handler: FileSystemEventHandler, path: str, recursive: bool = False):
+        self._handler = handler
+        self._path = os.path.normpath(path)
+        self._recursive = recursive
+        self._lock = RLock()
+        self._dispatcher = _Dispatcher(self)
+        self._polling_dispatcher = _Dispatcher(self, polling=True)
+        self._observer: Final[Observer] = Observer()
+        self._polling_observer: Final[PollingObserver] = PollingObserver(timeout=POLLING_INTERVAL)
+        # maps the root of every scheduled subtree onto the way it is monitored
+        self._subtrees: Final[Dict[str, str]] = dict()
+        self._should_exit: bool = False
+
+        if recursive and platform.system() == 'Linux' and \
+            (max_watches := _read_inotify_limit('max_user_watches')) is not None and \
+            (max_instances := _read_inotify_limit('max_user_instances')) is not None:
+            self._remaining_watches: Optional[int] = int(max_watches * INOTIFY_BUDGET_FRACTION)
+            self._remaining_instances: Optional[int] = min(int(max_instances * INOTIFY_BUDGET_FRACTION), MAX_INOTIFY_INSTANCES)
+        else:
+            self._remaining_watches = None
+            self._remaining_instances = None
+
+    def start(self):
+        self._observer.start()
+        self._polling_observer.start()
+        if not self._recursive:
+            self._schedule(self._path, NATIVE_FLAT)
+        elif self._remaining_watches is None:
+            self._schedule(self._path, NATIVE_RECURSIVE)
+        else:
+            Thread(target=self._assign, args=(self._path,), daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            self._should_exit = True
+        self._observer.stop()
+        self._polling_observer.stop()
+
+    @property
+    def subtrees(self) -> Dict[str, str]:
+        """
+        A copy of the mapping of the monitored subtrees onto the way they are monitored.
+        """
+        with self._lock:
+            return dict(self._subtrees)
+
+    def _schedule(self, path: str, mode: str) -> bool:
+        with self._lock:
+            if self._should_exit:
+                return False
+            try:
+                if mode == POLLING:
+                    self._polling_observer.schedule(self._polling_dispatcher, path, recursive=True)
+                else:
+                    self._observer.schedule(self._dispatcher, path, recursive=mode == NATIVE_RECURSIVE)
+            except OSError as e:
+                if mode == POLLING:
+                    raise
+                logging.warning(f"DirectoryMonitor: could not watch {path} ({e}), falling back to polling")
+                return self._schedule(path, POLLING)
+            self._subtrees[path] = mode
+            logging.debug(f"DirectoryMonitor: monitoring {path} using {mode}")
+            return True
+
+    def _assign(self, path: str):
+        # find the largest subtrees that fit within the remaining budget
+        pending: List[str] = [path]
+        while pending:
+            directory = pending.pop()
+            with self._lock:
+                if self._should_exit:
+                    return
+                remaining_watches = self._remaining_watches
+                remaining_instances = self._remaining_instances
+            if remaining_instances < 1 or remaining_watches < 1:
+                self._schedule(directory, POLLING)
+                continue
+            ndirs = count_directories(directory, remaining_watches)
+            if ndirs <= remaining_watches:
+                mode = NATIVE_RECURSIVE
+            else:
+                try:
+                    with os.scandir(directory) as entries:
+                        subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+                except OSError:
+                    subdirs = []
+                if len(subdirs) >= remaining_instances:
+                    # splitting would leave too few instances for the subdirectories,
+                    # and would end up polling each of them separately
+                    self._schedule(directory, POLLING)
+                    continue
+                # watch the directory itself, and try again with its subdirectories
+                mode = NATIVE_FLAT
+                ndirs = 1
+                pending.extend(subdirs)
+            with self._lock:
+                self._remaining_watches -= ndirs
+                self._remaining_instances -= 1
+            self._schedule(directory, mode)
+
+    def _mode_of(self, path: str) -> Optional[str]:
+        # the mode of the closest scheduled ancestor
+        while True:
+            if path in self._subtrees:
+                return self._subtrees[path]
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def _directory_created(self, path: str):
+        if not self._recursive or self._remaining_watches is None:
+            return
+        path = os.path.normpath(path)
+        with self._lock:
+            if path in self._subtrees:
+                return
+            mode = self._mode_of(os.path.dirname(path))
+            if mode == NATIVE_FLAT:
+                # the parent is not watched recursively, so the new directory needs its own watch
+                Thread(target=self._assign, args=(path,), daemon=True).start()
+            elif mode == NATIVE_RECURSIVE:
+                # watchdog adds a watch for the new directory by itself
+                self._remaining_watches -= 1
+                if self._remaining_watches < 0:
+                    # it may have been dropped when exceeding the kernel limit
+                    logging.warning(f"DirectoryMonitor: inotify watch budget exhausted, polling {path}")
+                    self._schedule(path, POLLING)
+
+class EventHandler(PatternMatchingEventHandler):
+    """
+    Forwards file state transitions from the observer thread to the file_created_cb
+    and file_changes_done_cb methods of callbacks, through dispatch.
+    By default, dispatch schedules them on the GLib main loop, which is the GUI thread.
+
+    With save_detection set to 'modified', modifications are coalesced per path:
+    a file is reported as saved only once no further modifications were seen
+    for MODIFIED_DEBOUNCE_WINDOW seconds, so callbacks receive a single event
+    per write burst instead of one per write.
+    The pending paths are kept in insertion order of their last modification,
+    which, given the constant window, is also the order of their deadlines.
+
+    With save_detection set to 'closed', modifications are ignored and files are reported
+    as saved as soon as the writer closes them (inotify IN_CLOSE_WRITE, Linux only).
+
+    Events of the subtrees that are polled arrive through dispatch_polled instead.
+    Polling never reports files being closed, only notices modifications every
+    POLLING_INTERVAL seconds, and may report a new file without any modification.
+    Therefore, with both 'modified' and 'closed', these files are reported as saved
+    once no modifications were seen for POLLING_INTERVAL + MODIFIED_DEBOUNCE_WINDOW
+    seconds after their creation or last modification. They are kept apart from
+    the other pending paths, so that both remain ordered by deadline.
+    With save_detection set to 'quiescent', all events are ignored, as the QuiescenceDetector
+    finds new files by scanning the directory, and takes care of reporting them as saved.
+    """
+    def __init__(self, callbacks, save_detection: str = 'modified', debounce_window: float = MODIFIED_DEBOUNCE_WINDOW, dispatch: Callable[..., Any] = GLib.idle_add):
+        self._callbacks = callbacks
+        self._dispatch = dispatch
+        super(EventHandler, self).__init__(ignore_patterns=IGNORE_PATTERNS)
+        self._save_detection = save_detection
+        self._debounce_window = debounce_window
+        self._cond = Condition()
+        self._pending: OrderedDictType[str, float] = OrderedDict()
+        self._pending_polled: OrderedDictType[str, float] = OrderedDict()
+        self._should_exit: bool = False
+        self._debounce_thread = Thread(target=self._debounce_worker, daemon=True)
+        self._debounce_thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._should_exit = True
+            self._pending.clear()
+            self._pending_polled.clear()
+            self._cond.notify()
+
+    def on_created(self, event):
+        # ignore directories being created
+        if not isinstance(event, FileCreatedEvent) or self._save_detection == 'quiescent':
+            return
+        
+        file_path = event.src_path
+        logging.debug(f"Monitor found {file_path} for event type CREATED")
+        self._dispatch(self._callbacks.file_created_cb, file_path, priority=GLib.PRIORITY_HIGH)
+
+    def on_modified(self, event):
+        # ignore directories being modified
+        if not isinstance(event, FileModifiedEvent) or self._save_detection != 'modified':
+            return
+
+        self._debounce(self._pending, event.src_path, self._debounce_window)
+
+    def dispatch_polled(self, event: FileSystemEvent):
+        """
+        Dispatches an event of a polled subtree.
+        """
+        if self._save_detection not in ('modified', 'closed') or \
+            not isinstance(event, (FileCreatedEvent, FileModifiedEvent)):
+            self.dispatch(event)
+            return
+        if any(fnmatch(os.path.basename(event.src_path), pattern) for pattern in IGNORE_PATTERNS):
+            return
+        if isinstance(event, FileCreatedEvent):
+            self.on_created(event)
+        self._debounce(self._pending_polled, event.src_path, self._debounce_window + POLLING_INTERVAL)
+
+    def _debounce(self, pending: OrderedDictType[str, float], file_path: str, window: float):
+        with self._cond:
+            pending[file_path] = time() + window
+            pending.move_to_end(file_path)
+            if len(pending) == 1:
+                self._cond.notify()
+
+    def on_closed(self, event):
+        if not isinstance(event, FileClosedEvent) or self._save_detection != 'closed':
+            return
+
+        file_path = event.src_path
+        logging.debug(f"Monitor found {file_path} for event type CLOSED")
+        self._dispatch(self._callbacks.file_changes_done_cb, file_path, priority=GLib.PRIORITY_DEFAULT_IDLE)
+
+    def _debounce_worker(self):
+        with self._cond:
+            while not self._should_exit:
+                heads = [(next(iter(pending.items())), pending) for pending in (self._pending, self._pending_polled) if pending]
+                if not heads:
+                    self._cond.wait()
+                    continue
+                (file_path, deadline), pending = min(heads, key=lambda head: head[0][1])
+                timeout = deadline - time()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                del pending[file_path]
+                logging.debug(f"Monitor found {file_path} for event type MODIFIED")
+                self._dispatch(self._callbacks.file_changes_done_cb, file_path, priority=GLib.PRIORITY_DEFAULT_IDLE)
@@ -3,7 +3,7 @@ import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 
-from typing import Final
+from typing import Any, Dict, Final, List, Optional
 
 from .file import File
 from .utils import WidgetParams
@@ -21,6 +21,11 @@ class OperationMeta(ABCMeta, type(Gtk.Frame)):
     pass
 
 class Operation(ABC, Gtk.Frame, WidgetParams, metaclass=OperationMeta):
+    """
+    Operations created with from_params do not run __init__: state that is used
+    by run() and postflight_cleanup() should be initialized in preflight_check,
+    or have a class-level default.
+    """
 
     @abstractmethod
     def __init__(self, *args, **kwargs):
@@ -33,6 +38,29 @@ class Operation(ABC, Gtk.Frame, WidgetParams, metaclass=OperationMeta):
         Gtk.Frame.__init__(self, *args, **kwargs)
         WidgetParams.__init__(self)
         self._index: Final[int] = 0
+        self._depends_on: Optional[List[int]] = None
+
+    @classmethod
+    def from_params(cls, params: Dict[str, Any], index: int, depends_on: Optional[List[int]] = None) -> 'Operation':
+        """
+        Create an operation from saved parameters, without building its widgets.
+        Used when running without a GUI.
+        """
+        operation = cls.__new__(cls)
+        WidgetParams.__init__(operation)
+        operation._params.update(params)
+        operation._index = index
+        operation._depends_on = None if depends_on is None else list(depends_on)
+        return operation
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        The representation of the operation in the YAML configuration files.
+        """
+        rv = dict(name=self.NAME, params=self.params)
+        if self.depends_on is not None:
+            rv['depends_on'] = self.depends_on
+        return rv
 
     def set_sensitive(self, sensitive: bool):
         for widget in self.widgets.values():
@@ -50,6 +78,29 @@ class Operation(ABC, Gtk.Frame, WidgetParams, metaclass=OperationMeta):
         self._index = value
         self.props.label = f"Operation {self._index + 1}: {self.NAME}"
 
+    @property
+    def depends_on(self) -> Optional[List[int]]:
+        """
+        The indices of the operations that need to succeed before this one can run.
+        If None, the operation depends on the one before it.
+        Operations that do not depend on each other may run concurrently for the same file.
+        """
+        return self._depends_on
+
+    @depends_on.setter
+    def depends_on(self, value: Optional[List[int]]):
+        self._depends_on = None if value is None else list(value)
+
+    @property
+    def concurrency_limit(self) -> Optional[int]:
+        """
+        The maximum number of files this operation may process at the same time,
+        or None if it is only limited by the number of threads.
+        Override this for operations that share a limited resource,
+        such as connections to a server.
+        """
+        return None
+
     @property
     @classmethod
     @abstractmethod
@@ -68,6 +119,11 @@ class Operation(ABC, Gtk.Frame, WidgetParams, metaclass=OperationMeta):
         Since this will be done in a worker-thread, you cannot directly
         call any methods that update the GUI.
 
+        Return None on success, or an error message otherwise.
+        Operations that finish processing the file later, in another thread,
+        may return a concurrent.futures.Future instead, which must be resolved
+        with None or an error message. The worker is released right away,
+        but the operation is only considered done once the future is resolved.
         """
         raise NotImplementedError
 
@@ -2,25 +2,48 @@ import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 import boto3
+from boto3.s3.transfer import TransferConfig, ProgressCallbackInvoker, create_transfer_manager
+from s3transfer.manager import TransferManager
 import botocore
+from botocore.config import Config
 
 #pylint: disable=relative-beyond-top-level
 from ..operation import Operation
 from ..file import File
-from ..job import Job
+from ..job import Worker
+from ..dedup import DedupCache
+from ..bandwidth import MB, TokenBucket, throttle
+from ..checksums import checksum_metadata, compute_digests, hashing_reader, parse_algorithms, store_digests
+from ..utils import DEDUP_CACHE_FILE
 
+import io
+import json
 import logging
 import os
+import tarfile
 import tempfile
+import time
+import uuid
+from concurrent.futures import Future
 from pathlib import PurePosixPath
-from threading import current_thread, Lock
+from threading import current_thread, get_ident, Lock, Thread, Timer
+from typing import Any, Dict, Final, List, Optional, Sequence, Tuple
 import urllib
 
+# prefix of the keys of the archives created when bundling small files
+ARCHIVE_PREFIX: Final[str] = 'archives/'
+
 # useful info from help(boto3.session.Session.client)
 
 class S3UploaderOperation(Operation):
     NAME = "S3 Uploader"
 
+    _transfer_manager: Optional[TransferManager] = None
+    _bundler: Optional['S3Bundler'] = None
+    _dedup_cache: Optional[DedupCache] = None
+    _bandwidth: Optional[TokenBucket] = None
+    _checksum_algorithms: Sequence[str] = ()
+
     def __init__(self, *args, **kwargs):
         Operation.__init__(self, *args, **kwargs)
         self._grid = Gtk.Grid(
@@ -99,6 +122,140 @@ class S3UploaderOperation(Operation):
         ), 'force_bucket_creation')
         self._grid.attach(widget, 2, 3, 1, 1)
 
+        # Transfer settings
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 4, 3, 1)
+        for column, (label, param_name, lower, upper, value) in enumerate((
+            ("Multipart threshold (MB)", 'multipart_threshold', 5, 5120, 8),
+            ("Part size (MB)", 'multipart_chunksize', 5, 5120, 8),
+            ("Concurrent requests", 'max_concurrency', 1, 256, 10),
+            ("HTTP connections", 'max_pool_connections', 1, 256, 10),
+            )):
+            tempgrid.attach(Gtk.Label(
+                label=label,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False,
+            ), 2 * column, 0, 1, 1)
+            widget = self.register_widget(Gtk.SpinButton(
+                adjustment=Gtk.Adjustment(
+                    lower=lower,
+                    upper=upper,
+                    value=value,
+                    page_size=0,
+                    step_increment=1),
+                value=value,
+                update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+                numeric=True,
+                climb_rate=1,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), param_name)
+            tempgrid.attach(widget, 2 * column + 1, 0, 1, 1)
+
+        # Bundling of small files
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 5, 3, 1)
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Bundle files smaller than (kB)",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'bundle_small_files')
+        tempgrid.attach(widget, 0, 0, 1, 1)
+        for column, (label, param_name, lower, upper, value) in enumerate((
+            (None, 'bundle_max_file_size', 1, 1048576, 1024),
+            ("into archives of at most (MB)", 'bundle_max_size', 1, 5120, 100),
+            ("or (seconds)", 'bundle_max_age', 1, 3600, 60),
+            )):
+            if label:
+                tempgrid.attach(Gtk.Label(
+                    label=label,
+                    halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                    hexpand=False, vexpand=False,
+                ), 2 * column, 0, 1, 1)
+            widget = self.register_widget(Gtk.SpinButton(
+                adjustment=Gtk.Adjustment(
+                    lower=lower,
+                    upper=upper,
+                    value=value,
+                    page_size=0,
+                    step_increment=1),
+                value=value,
+                update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+                numeric=True,
+                climb_rate=1,
+                halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+                hexpand=False, vexpand=False), param_name)
+            tempgrid.attach(widget, 2 * column + 1, 0, 1, 1)
+
+        # Deduplication
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Copy files with previously uploaded contents within the bucket instead of uploading them",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'deduplicate')
+        self._grid.attach(widget, 0, 6, 3, 1)
+
+        # Bandwidth
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 7, 3, 1)
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Limit the bandwidth of this operation to (MB/s)",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'bandwidth_limit_active')
+        tempgrid.attach(widget, 0, 0, 1, 1)
+        widget = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=100000,
+                value=100,
+                page_size=0,
+                step_increment=1),
+            value=100,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=1,
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'bandwidth_limit')
+        tempgrid.attach(widget, 1, 0, 1, 1)
+
+        # Checksums
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 8, 3, 1)
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Compute checksums while uploading",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'compute_checksums')
+        tempgrid.attach(widget, 0, 0, 1, 1)
+        widget = self.register_widget(Gtk.Entry(
+            placeholder_text="md5, sha256",
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        ), 'checksum_algorithms')
+        tempgrid.attach(widget, 1, 0, 1, 1)
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Have the server verify a SHA256 checksum of every request",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'server_checksum')
+        tempgrid.attach(widget, 2, 0, 1, 1)
+
     def preflight_check(self):
         self._client_options = dict()
         self._client_options['endpoint_url'] = self.params.hostname
@@ -108,7 +265,29 @@ class S3UploaderOperation(Operation):
         logging.debug(f'{self._client_options=}')
 
         # open connection (things can definitely go wrong here!)
-        self._s3_client = boto3.client('s3', **self._client_options)
+        self._s3_client = boto3.client('s3',
+            config=Config(max_pool_connections=int(self.params.max_pool_connections)),
+            **self._client_options)
+
+        # all jobs share a single transfer manager, and therefore its thread and connection pools
+        self._transfer_manager = create_transfer_manager(self._s3_client, TransferConfig(
+            multipart_threshold=int(self.params.multipart_threshold) * MB,
+            multipart_chunksize=int(self.params.multipart_chunksize) * MB,
+            max_concurrency=int(self.params.max_concurrency),
+            ))
+
+        if self.params.deduplicate:
+            self._dedup_cache = DedupCache(str(DEDUP_CACHE_FILE))
+
+        if self.params.bandwidth_limit_active:
+            self._bandwidth = TokenBucket(self.params.bandwidth_limit * MB)
+
+        self._checksum_algorithms = parse_algorithms(self.params.checksum_algorithms) if self.params.compute_checksums else ()
+
+        if self.params.bundle_small_files:
+            self._bundler = S3Bundler(self,
+                max_size=int(self.params.bundle_max_size) * MB,
+                max_age=self.params.bundle_max_age)
 
         # check if the bucket exists
         # taken from https://stackoverflow.com/a/47565719
@@ -138,12 +317,11 @@ class S3UploaderOperation(Operation):
                 f.write(os.urandom(1024)) # 1 kB
                 tmpfile = f.name
             try:
-                self._s3_client.upload_file(
-                    Filename=tmpfile,
-                    Bucket=self.params.bucket_name,
-                    Key=os.path.basename(tmpfile),
-                    Config = boto3.s3.transfer.TransferConfig(max_concurrency=1),
-                    )
+                self._transfer_manager.upload(
+                    fileobj=tmpfile,
+                    bucket=self.params.bucket_name,
+                    key=os.path.basename(tmpfile),
+                    ).result()
             except:
                 raise
             else:
@@ -155,46 +333,156 @@ class S3UploaderOperation(Operation):
             finally:
                 os.unlink(tmpfile)
 
+    def object_url(self, key: str) -> str:
+        parsed_url = urllib.parse.urlparse(self._client_options['endpoint_url'])
+        return f'{parsed_url.scheme}://{self.params.bucket_name}.{parsed_url.netloc}/{urllib.parse.quote(key)}'
+
+    @property
+    def concurrency_limit(self) -> Optional[int]:
+        # every upload needs at least one of the requests of the shared transfer manager
+        return int(self.params.max_concurrency)
+
+    @property
+    def transfer_manager(self) -> TransferManager:
+        return self._transfer_manager
+
+    @property
+    def checksum_algorithms(self) -> Sequence[str]:
+        """
+        The hashlib algorithms of the checksums that are added to the metadata of the files.
+        """
+        return self._checksum_algorithms
+
+    @property
+    def extra_args(self) -> Optional[Dict[str, str]]:
+        """
+        The extra arguments of all uploads. With server_checksum, botocore computes
+        a checksum of the bytes it sends, and S3 rejects requests for which it does not match.
+        This is opt-in: over HTTPS it requires support for aws-chunked uploads, which many
+        S3-compatible servers lack, and over HTTP botocore reads every request body twice.
+        """
+        return {'ChecksumAlgorithm': 'SHA256'} if self.params.get('server_checksum', False) else None
+
+    def throttle(self, nbytes: int):
+        """
+        Block until nbytes may be sent, according to the bandwidth limits.
+        """
+        throttle(nbytes, self._bandwidth)
+
+    @property
+    def _dedup_destination(self) -> str:
+        return f"{self._client_options['endpoint_url']}/{self.params.bucket_name}"
+
+    def _copy_duplicate(self, file: File, key: str, digest: str, size: int) -> Optional[Dict[str, Any]]:
+        # server-side copy of an object with the same contents, if there is one
+        source_key = self._dedup_cache.lookup(self._dedup_destination, digest, size)
+        if source_key is None:
+            return None
+        if source_key != key:
+            try:
+                self._transfer_manager.copy(
+                    copy_source={'Bucket': self.params.bucket_name, 'Key': source_key},
+                    bucket=self.params.bucket_name,
+                    key=key,
+                    extra_args=self.extra_args,
+                    ).result()
+            except botocore.exceptions.ClientError:
+                # most likely the object was removed from the bucket
+                logging.info(f"Could not copy {source_key} to {key}, uploading {file._filename} instead")
+                self._dedup_cache.discard(self._dedup_destination, source_key)
+                return None
+        logging.info(f"S3 copy complete from {source_key} to {key} for {file._filename}")
+        return {'s3 object url': self.object_url(key), 's3 copied from': self.object_url(source_key)}
+
     def run(self, file: File):
         thread = current_thread()
 
+        #TODO: do not allow overwriting existing keys in bucket??
+        key = str(PurePosixPath(*file.relative_filename.parts))
+
+        if self._bundler is not None:
+            try:
+                if os.path.getsize(file._filename) < self.params.bundle_max_file_size * 1024:
+                    file.operation_metadata[self.index], future = self._bundler.add(file, key)
+                    logging.debug(f"{file.operation_metadata[self.index]=}")
+                    # the file is done once its archive has been uploaded
+                    return future
+            except Exception as e:
+                logging.exception(f'S3UploaderOperation.run exception')
+                return str(e)
+
+        if self._dedup_cache is not None:
+            try:
+                size = os.path.getsize(file._filename)
+                # the checksums are computed in the same pass, and will not be computed again while uploading
+                digest = self._dedup_cache.digest(file, self._checksum_algorithms)
+                if (metadata := self._copy_duplicate(file, key, digest, size)) is not None:
+                    metadata.update(checksum_metadata(compute_digests(file, self._checksum_algorithms)))
+                    file.operation_metadata[self.index] = metadata
+                    logging.debug(f"{file.operation_metadata[self.index]=}")
+                    return None
+            except Exception as e:
+                logging.exception(f'S3UploaderOperation.run exception')
+                return str(e)
+
+        reader = None
         try:
-            #TODO: do not allow overwriting existing keys in bucket??
-            key = str(PurePosixPath(*file._relative_filename.parts))
-            self._s3_client.upload_file( \
-                Filename=file._filename,\
-                Bucket=self.params.bucket_name,
-                Key=key,
-                ExtraArgs = None, # TODO: add support for ACL??
-                Config = boto3.s3.transfer.TransferConfig(max_concurrency=1),
-                Callback = S3ProgressPercentage(file, thread, self),
-                )
+            # checksums are computed on the bytes that are read for uploading,
+            # which s3transfer does in order when given a file object instead of a filename
+            reader = hashing_reader(file, self._checksum_algorithms)
+            self._transfer_manager.upload(
+                fileobj=reader if reader is not None else file._filename,
+                bucket=self.params.bucket_name,
+                key=key,
+                extra_args=self.extra_args, # TODO: add support for ACL??
+                subscribers=[ProgressCallbackInvoker(S3ProgressPercentage(file, thread, self))],
+                ).result()
+            digests = store_digests(file, reader, self._checksum_algorithms)
         except Exception as e:
             logging.exception(f'S3UploaderOperation.run exception')
             return str(e)
         else:
+            if self._dedup_cache is not None:
+                self._dedup_cache.add(self._dedup_destination, digest, size, key)
             #add object URL to metadata
-            parsed_url = urllib.parse.urlparse(self._client_options['endpoint_url'])
-            file.operation_metadata[self.index] = {'s3 object url':
-                f'{parsed_url.scheme}://{self.params.bucket_name}.{parsed_url.netloc}/{urllib.parse.quote(key)}'}
+            file.operation_metadata[self.index] = {'s3 object url': self.object_url(key), **checksum_metadata(digests)}
             logging.info(f"S3 upload complete from {file._filename} to {self.params.bucket_name}")
             logging.debug(f"{file.operation_metadata[self.index]=}")
+        finally:
+            if reader is not None:
+                reader.close()
         return None
 
+    def postflight_cleanup(self):
+        if self._bundler is not None:
+            # upload whatever is left in the current archive
+            self._bundler.close()
+            self._bundler = None
+        if self._transfer_manager is not None:
+            self._transfer_manager.shutdown()
+            self._transfer_manager = None
+        if self._dedup_cache is not None:
+            self._dedup_cache.close()
+            self._dedup_cache = None
+        self._bandwidth = None
+
 # taken from https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
 class S3ProgressPercentage(object):
 
-    def __init__(self, file: File, thread: Job, operation: Operation):
+    def __init__(self, file: File, thread: Worker, operation: Operation):
         self._file = file
         self._filename = file._filename
         self._size = float(os.path.getsize(self._filename))
         self._seen_so_far = 0
         self._last_percentage = 0
-        self._lock = Lock() # not sure this is necessary since we are using just one thread
+        self._lock = Lock() # parts of multipart uploads are sent concurrently
         self._thread = thread
         self._operation = operation
 
     def __call__(self, bytes_amount):
+        # called after every chunk that was read for sending: wait here to limit the bandwidth,
+        # outside of the lock to let the other parts through
+        self._operation.throttle(bytes_amount)
         # To simplify, assume this is hooked up to a single filename
         with self._lock:
             self._seen_so_far += bytes_amount
@@ -202,3 +490,135 @@ class S3ProgressPercentage(object):
             if int(percentage) > self._last_percentage:
                 self._last_percentage = int(percentage)
                 self._file.update_progressbar(self._operation.index, self._last_percentage)
+
+class _Archive:
+    def __init__(self, owner: int):
+        with tempfile.NamedTemporaryFile(suffix='.tar', delete=False) as f:
+            self.filename: Final[str] = f.name
+        self.key: Final[str] = f"{ARCHIVE_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.tar"
+        self.tar: Final[tarfile.TarFile] = tarfile.open(self.filename, 'w', format=tarfile.PAX_FORMAT)
+        # member name, offset and size of its data within the archive
+        self.members: Final[List[Tuple[str, int, int]]] = []
+        # resolved once the archive has been uploaded
+        self.future: Final[Future] = Future()
+        # the thread that adds files to the archive
+        self.owner: Final[int] = owner
+        # guards against the archive being sealed by its timer while a file is added
+        self.lock = Lock()
+        self.sealed: bool = False
+        self.timer: Optional[Timer] = None
+
+class S3Bundler:
+    """
+    Collects small files into rolling, uncompressed tar archives, which are uploaded
+    as single objects once they exceed max_size bytes or max_age seconds,
+    together with a JSON index mapping each member onto its byte offset and size.
+
+    Every worker thread writes to its own archive, so files are copied concurrently.
+    Files remain running until their archive has been uploaded: add returns
+    a future that is resolved with None, or with an error message if the upload failed.
+    """
+    def __init__(self, operation: S3UploaderOperation, max_size: int, max_age: float):
+        self._operation = operation
+        self._max_size = max_size
+        self._max_age = max_age
+        self._lock = Lock()
+        self._archives: Dict[int, _Archive] = dict()
+        self._upload_threads: List[Thread] = []
+
+    def _current_archive(self) -> _Archive:
+        owner = get_ident()
+        with self._lock:
+            if (archive := self._archives.get(owner)) is None:
+                archive = self._archives[owner] = _Archive(owner)
+                archive.timer = Timer(self._max_age, self._seal_expired, args=(archive,))
+                archive.timer.daemon = True
+                archive.timer.start()
+            return archive
+
+    def add(self, file: File, key: str) -> Tuple[Dict[str, Any], Future]:
+        """
+        Add file to the archive of the current thread as key. Returns the metadata
+        describing its location, and the future of the upload of the archive.
+        """
+        while True:
+            archive = self._current_archive()
+            with archive.lock:
+                if archive.sealed:
+                    # sealed by its timer in the meantime
+                    continue
+                tarinfo = archive.tar.gettarinfo(file._filename, arcname=key)
+                reader = hashing_reader(file, self._operation.checksum_algorithms)
+                with reader if reader is not None else open(file._filename, 'rb') as f:
+                    archive.tar.addfile(tarinfo, f)
+                # the data of the member ends on the last block that was written
+                padded_size = tarfile.BLOCKSIZE * ((tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE)
+                offset = archive.tar.offset - padded_size
+                archive.members.append((key, offset, tarinfo.size))
+                if archive.tar.offset >= self._max_size:
+                    self._seal(archive)
+                break
+        file.update_progressbar(self._operation.index, 100)
+        return {
+            's3 object url': self._operation.object_url(archive.key),
+            's3 archive member': key,
+            's3 archive offset': offset,
+            's3 archive size': tarinfo.size,
+            **checksum_metadata(store_digests(file, reader, self._operation.checksum_algorithms)),
+        }, archive.future
+
+    def _seal_expired(self, archive: _Archive):
+        with archive.lock:
+            if not archive.sealed:
+                self._seal(archive)
+
+    def _seal(self, archive: _Archive):
+        # must be called while holding the lock of the archive
+        archive.sealed = True
+        archive.timer.cancel()
+        archive.tar.close()
+        thread = Thread(target=self._upload, args=(archive,), daemon=True)
+        with self._lock:
+            if self._archives.get(archive.owner) is archive:
+                del self._archives[archive.owner]
+            self._upload_threads = [t for t in self._upload_threads if t.is_alive()]
+            self._upload_threads.append(thread)
+        thread.start()
+
+    def _upload(self, archive: _Archive):
+        index = {key: dict(offset=offset, size=size) for key, offset, size in archive.members}
+        try:
+            logging.debug(f"S3Bundler: uploading {archive.key} with {len(index)} members")
+            self._operation.transfer_manager.upload(
+                fileobj=archive.filename,
+                bucket=self._operation.params.bucket_name,
+                key=archive.key,
+                extra_args=self._operation.extra_args,
+                subscribers=[ProgressCallbackInvoker(self._operation.throttle)],
+                ).result()
+            self._operation.transfer_manager.upload(
+                fileobj=io.BytesIO(json.dumps(index).encode('utf-8')),
+                bucket=self._operation.params.bucket_name,
+                key=archive.key + '.index.json',
+                ).result()
+        except Exception as e:
+            logging.exception(f'S3Bundler: could not upload {archive.key}')
+            archive.future.set_result(f'Could not upload archive {archive.key}: {e}')
+        else:
+            logging.info(f"S3 upload complete of archive {archive.key} with {len(index)} members")
+            archive.future.set_result(None)
+        finally:
+            os.unlink(archive.filename)
+
+    def close(self):
+        """
+        Upload the current archives, and wait until all uploads have finished.
+        """
+        with self._lock:
+            archives = list(self._archives.values())
+        for archive in archives:
+            self._seal_expired(archive)
+        with self._lock:
+            threads = self._upload_threads[:]
+        for thread in threads:
+            thread.join()
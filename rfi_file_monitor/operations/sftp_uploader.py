@@ -3,24 +3,50 @@ gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 import paramiko
 from paramiko import AutoAddPolicy, RejectPolicy
+from paramiko.sftp import CMD_EXTENDED, int64
 
 #pylint: disable=relative-beyond-top-level
 from ..operation import Operation
 from ..file import File
 from ..job import Job
+from ..dedup import DedupCache
+from ..bandwidth import MB, TokenBucket, throttle
+from ..checksums import HashingReader, checksum_metadata, compute_digests, hashing_reader, parse_algorithms, store_digests
+from ..utils import DEDUP_CACHE_FILE
 
 import logging
 import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import PurePosixPath
-from stat import S_ISDIR, S_ISREG
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+from queue import Full, Queue
+from threading import Lock
+from typing import Callable, Final, Iterator, List, Optional, Sequence, Set, Tuple
 import posixpath
 
+# transport settings used in high-throughput mode
+HIGH_THROUGHPUT_WINDOW_SIZE: Final[int] = 2 ** 27 # 128 MB
+HIGH_THROUGHPUT_MAX_PACKET_SIZE: Final[int] = 2 ** 18 # 256 kB
+# size of the blocks read from the local file in high-throughput mode,
+# paramiko splits them into pipelined write requests
+HIGH_THROUGHPUT_CHUNK_SIZE: Final[int] = 2 ** 20 # 1 MB
+# number of chunks that may be waiting for each connection when splitting a file
+RANGE_SPLIT_QUEUE_SIZE: Final[int] = 4
+
 
 
 class SftpUploaderOperation(Operation):
     NAME = "SFTP Uploader"
 
+    _pool: Optional['SftpConnectionPool'] = None
+    _dedup_cache: Optional[DedupCache] = None
+    _bandwidth: Optional[TokenBucket] = None
+    _checksum_algorithms: Sequence[str] = ()
+    # cleared once the server turns out not to support copying files
+    _remote_copy: bool = True
+
     def __init__(self, *args, **kwargs):
         Operation.__init__(self, *args, **kwargs)
         self._grid = Gtk.Grid(
@@ -150,69 +176,409 @@ class SftpUploaderOperation(Operation):
         ), 'auto_add_keys')
         tempgrid.attach(widget, 0, 0, 1, 1)
 
-    def preflight_check(self):
-        # try connecting to server and copy a simple file
-        logging.debug(f"Try opening an ssh connection to {self.params.hostname}")
-        with paramiko.SSHClient() as client:
+        # High-throughput mode
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 4, 1, 1)
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="High-throughput transfers",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'high_throughput')
+        tempgrid.attach(widget, 0, 0, 1, 1)
+        tempgrid.attach(Gtk.Label(
+            label='Preferred cipher',
+            halign=Gtk.Align.END, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        ), 1, 0, 1, 1)
+        widget = self.register_widget(Gtk.Entry(
+            placeholder_text="aes128-gcm@openssh.com",
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        ), 'preferred_cipher')
+        tempgrid.attach(widget, 2, 0, 1, 1)
+
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 5, 1, 1)
+        tempgrid.attach(Gtk.Label(
+            label='Split files larger than',
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 0, 0, 1, 1)
+        widget = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=1000000,
+                value=256,
+                page_size=0,
+                step_increment=1),
+            value=256,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=5,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'range_split_threshold')
+        tempgrid.attach(widget, 1, 0, 1, 1)
+        tempgrid.attach(Gtk.Label(
+            label='MB over',
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 2, 0, 1, 1)
+        widget = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=16,
+                value=1,
+                page_size=0,
+                step_increment=1),
+            value=1,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=1,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'range_split_channels')
+        tempgrid.attach(widget, 3, 0, 1, 1)
+        tempgrid.attach(Gtk.Label(
+            label='concurrent connections (high-throughput mode only)',
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 4, 0, 1, 1)
+
+        # Concurrent uploads
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 7, 1, 1)
+        tempgrid.attach(Gtk.Label(
+            label='Concurrent uploads',
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 0, 0, 1, 1)
+        widget = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=256,
+                value=4,
+                page_size=0,
+                step_increment=1),
+            value=4,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=1,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'max_concurrent_uploads')
+        tempgrid.attach(widget, 1, 0, 1, 1)
+
+        # Bandwidth
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Limit the bandwidth of this operation to (MB/s)",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'bandwidth_limit_active')
+        tempgrid.attach(widget, 2, 0, 1, 1)
+        widget = self.register_widget(Gtk.SpinButton(
+            adjustment=Gtk.Adjustment(
+                lower=1,
+                upper=100000,
+                value=100,
+                page_size=0,
+                step_increment=1),
+            value=100,
+            update_policy=Gtk.SpinButtonUpdatePolicy.IF_VALID,
+            numeric=True,
+            climb_rate=1,
+            halign=Gtk.Align.CENTER, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False), 'bandwidth_limit')
+        tempgrid.attach(widget, 3, 0, 1, 1)
+
+        # Deduplication
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Copy files with previously uploaded contents on the server instead of uploading them",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'deduplicate')
+        self._grid.attach(widget, 0, 6, 1, 1)
+
+        # Checksums
+        tempgrid = Gtk.Grid(
+            row_spacing=5, column_spacing=5,
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        )
+        self._grid.attach(tempgrid, 0, 8, 1, 1)
+        widget = self.register_widget(Gtk.CheckButton(
+            active=False, label="Compute checksums while uploading",
+            halign=Gtk.Align.START, valign=Gtk.Align.CENTER,
+            hexpand=False, vexpand=False,
+        ), 'compute_checksums')
+        tempgrid.attach(widget, 0, 0, 1, 1)
+        widget = self.register_widget(Gtk.Entry(
+            placeholder_text="md5, sha256",
+            halign=Gtk.Align.FILL, valign=Gtk.Align.CENTER,
+            hexpand=True, vexpand=False,
+        ), 'checksum_algorithms')
+        tempgrid.attach(widget, 1, 0, 1, 1)
+
+    def _connect(self) -> Tuple[paramiko.SSHClient, paramiko.SFTPClient]:
+        logging.debug(f"Opening an ssh connection to {self.params.hostname}")
+        client = paramiko.SSHClient()
+        try:
             client.load_system_host_keys()
             client.set_missing_host_key_policy(AutoAddPolicy if self.params.auto_add_keys else RejectPolicy)
             client.connect(self.params.hostname,
                 port=int(self.params.port),
                 username=self.params.username,
                 password=self.params.password,
+                transport_factory=self._high_throughput_transport if self.params.high_throughput else None,
                 )
-            logging.debug(f"Try opening an sftp connection to {self.params.hostname}")
-            with client.open_sftp() as sftp_client:
-                try:
-                    sftp_client.chdir(self.params.destination)
-                except IOError:
-                    if self.params.force_folder_creation:
-                        makedirs(sftp_client, self.params.destination)
-                    else:
-                        raise
-                # cd back to home folder
-                sftp_client.chdir()
-
-                # try copying a file
-                logging.debug(f"Try uploading a test file to {self.params.destination}")
-                with tempfile.NamedTemporaryFile(delete=False) as f:
-                    f.write(os.urandom(1024)) # 1 kB
-                    tmpfile = f.name
-                try:
-                    sftp_client.put(tmpfile, self.params.destination + '/' + os.path.basename(tmpfile))
-                except:
-                    raise
+            logging.debug(f"Opening an sftp connection to {self.params.hostname}")
+            if self.params.high_throughput:
+                sftp_client = paramiko.SFTPClient.from_transport(client.get_transport(),
+                    window_size=HIGH_THROUGHPUT_WINDOW_SIZE,
+                    max_packet_size=HIGH_THROUGHPUT_MAX_PACKET_SIZE,
+                    )
+            else:
+                sftp_client = client.open_sftp()
+        except:
+            client.close()
+            raise
+        return client, sftp_client
+
+    def _high_throughput_transport(self, sock, **kwargs) -> paramiko.Transport:
+        transport = paramiko.Transport(sock,
+            default_window_size=HIGH_THROUGHPUT_WINDOW_SIZE,
+            default_max_packet_size=HIGH_THROUGHPUT_MAX_PACKET_SIZE,
+            **kwargs)
+        # move the preferred cipher to the front, the others remain available as fallback
+        options = transport.get_security_options()
+        cipher = self.params.preferred_cipher
+        if cipher in options.ciphers:
+            options.ciphers = (cipher,) + tuple(c for c in options.ciphers if c != cipher)
+        else:
+            logging.warning(f"Cipher {cipher} is not supported, using defaults instead")
+        return transport
+
+    def preflight_check(self):
+        # try connecting to server and copy a simple file
+        # the connection will be kept in the pool for use by run()
+        self._pool = SftpConnectionPool(self._connect)
+        # remote directories known to exist, shared by all sessions of the pool
+        self._remote_dirs: Set[str] = set()
+        if self.params.deduplicate:
+            self._dedup_cache = DedupCache(str(DEDUP_CACHE_FILE))
+            self._remote_copy = True
+        if self.params.bandwidth_limit_active:
+            self._bandwidth = TokenBucket(self.params.bandwidth_limit * MB)
+        self._checksum_algorithms = parse_algorithms(self.params.checksum_algorithms) if self.params.compute_checksums else ()
+        with self._pool.session() as sftp_client:
+            try:
+                sftp_client.chdir(self.params.destination)
+            except IOError:
+                if self.params.force_folder_creation:
+                    makedirs(sftp_client, self.params.destination)
                 else:
-                    # if successful, remove it
-                    sftp_client.remove(self.params.destination + '/' + os.path.basename(tmpfile))
-                finally:
-                    os.unlink(tmpfile)
+                    raise
+            # cd back to home folder
+            sftp_client.chdir()
+
+            # try copying a file
+            logging.debug(f"Try uploading a test file to {self.params.destination}")
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(os.urandom(1024)) # 1 kB
+                tmpfile = f.name
+            try:
+                sftp_client.put(tmpfile, self.params.destination + '/' + os.path.basename(tmpfile))
+            except:
+                raise
+            else:
+                # if successful, remove it
+                sftp_client.remove(self.params.destination + '/' + os.path.basename(tmpfile))
+            finally:
+                os.unlink(tmpfile)
+
+    def postflight_cleanup(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._dedup_cache is not None:
+            self._dedup_cache.close()
+            self._dedup_cache = None
+        self._bandwidth = None
+
+    def throttle(self, nbytes: int):
+        """
+        Block until nbytes may be sent, according to the bandwidth limits.
+        """
+        throttle(nbytes, self._bandwidth)
+
+    @property
+    def concurrency_limit(self) -> Optional[int]:
+        # each upload needs its own session, with its own ssh connection
+        return int(self.params.max_concurrent_uploads)
+
+    @property
+    def _dedup_destination(self) -> str:
+        return f'sftp://{self.params.username}@{self.params.hostname}:{int(self.params.port)}'
+
+    def _find_duplicate(self, sftp_client: paramiko.SFTPClient, digest: str, size: int) -> Optional[str]:
+        # a hit does not create the destination file by itself: the file with the same contents
+        # is copied onto it on the server instead of uploading it, see copy_remote. Only recording
+        # its location, or linking to it, would go wrong as soon as it is overwritten or removed.
+        # Servers that cannot copy get an upload, so the destination file always exists afterwards.
+        existing = self._dedup_cache.lookup(self._dedup_destination, digest, size)
+        if existing is None:
+            return None
+        try:
+            attributes = sftp_client.lstat(existing)
+            if not S_ISREG(attributes.st_mode) or attributes.st_size != size:
+                raise IOError(f'{existing} has been modified')
+        except IOError:
+            self._dedup_cache.discard(self._dedup_destination, existing)
+            return None
+        logging.debug(f"Found a file with the same contents at {existing}")
+        return existing
+
+    def _copy_duplicate(self, sftp_client: paramiko.SFTPClient, existing: str, remote_filename: str, size: int) -> bool:
+        # returns False if the file needs to be uploaded after all
+        try:
+            copy_remote(sftp_client, existing, remote_filename, size)
+        except UnsupportedError:
+            logging.warning(f"{self.params.hostname} cannot copy files, duplicates will be uploaded")
+            self._remote_copy = False
+            return False
+        except IOError as e:
+            logging.info(f"Could not copy {existing} to {remote_filename} ({e}), uploading instead")
+            return False
+        logging.debug(f"Copied {existing} to {remote_filename}")
+        return True
+
+    def _upload(self, sftp_client: paramiko.SFTPClient, file: File) -> Tuple[str, Optional[str]]:
+        # returns the full remote filename, and the one it was copied from if its contents were uploaded earlier
+        rel_filename = str(PurePosixPath(*file.relative_filename.parts))
+        remote_filename = posixpath.join(self.params.destination, rel_filename)
+        makedirs(sftp_client, posixpath.dirname(remote_filename), cache=self._remote_dirs)
+        # never write through a symlink, which would overwrite the file it points to
+        remove_symlink(sftp_client, remote_filename)
+        if self._dedup_cache is not None:
+            size = os.path.getsize(file._filename)
+            # the checksums are computed in the same pass, and will not be computed again while uploading
+            digest = self._dedup_cache.digest(file, self._checksum_algorithms)
+            if self._remote_copy and \
+                (existing := self._find_duplicate(sftp_client, digest, size)) is not None and \
+                self._copy_duplicate(sftp_client, existing, remote_filename, size):
+                return sftp_client.normalize(remote_filename), existing
+        callback = SftpProgressPercentage(file, self)
+        reader = None
+        if not self.params.high_throughput:
+            # checksums are computed on the bytes that are read for uploading
+            reader = hashing_reader(file, self._checksum_algorithms)
+            with reader if reader is not None else open(file._filename, 'rb') as fl:
+                sftp_client.putfo(fl, remote_filename, os.path.getsize(file._filename), callback=callback)
+        elif int(self.params.range_split_channels) > 1 and \
+            os.path.getsize(file._filename) > self.params.range_split_threshold * 1024 * 1024:
+            reader = hashing_reader(file, self._checksum_algorithms)
+            self._put_ranges(sftp_client, file._filename, remote_filename, callback, reader)
+        else:
+            size = os.path.getsize(file._filename)
+            reader = hashing_reader(file, self._checksum_algorithms)
+            put_range(sftp_client, file._filename, remote_filename, 'wb', 0, size, TransferredBytes(size, callback), reader)
+        store_digests(file, reader, self._checksum_algorithms)
+        remote_filename_full = sftp_client.normalize(remote_filename)
+        logging.debug(f"File {remote_filename_full} has been written")
+        if self._dedup_cache is not None:
+            self._dedup_cache.add(self._dedup_destination, digest, size, remote_filename_full)
+        return remote_filename_full, None
+
+    def _put_ranges(self, sftp_client: paramiko.SFTPClient, localpath: str, remotepath: str, callback: Callable[[int, int], None], reader: Optional[HashingReader] = None):
+        # the file is read once, in order, so that reader can compute the checksums on the way,
+        # while its chunks are handed out round-robin to connections from the pool,
+        # which write them concurrently at their offsets
+        size = os.path.getsize(localpath)
+        nchannels = int(self.params.range_split_channels)
+        progress = TransferredBytes(size, callback)
+
+        # create the remote file with its final size, so the chunks can be written in place
+        with sftp_client.open(remotepath, 'wb') as f:
+            f.truncate(size)
+
+        def _put_chunks_worker(client: Optional[paramiko.SFTPClient], queue: Queue):
+            with self._pool.session() if client is None else nullcontext(client) as range_client, \
+                range_client.open(remotepath, 'r+b') as fr:
+                fr.set_pipelined(True)
+                while (chunk := queue.get()) is not None:
+                    offset, data = chunk
+                    fr.seek(offset)
+                    fr.write(data)
+                    progress(len(data))
+
+        def _hand_out(index: int, chunk: Optional[Tuple[int, bytes]]) -> bool:
+            # returns False if the connection failed, instead of waiting for it forever
+            while not futures[index].done():
+                try:
+                    queues[index].put(chunk, timeout=1.0)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        queues = [Queue(maxsize=RANGE_SPLIT_QUEUE_SIZE) for _ in range(nchannels)]
+        with ThreadPoolExecutor(max_workers=nchannels) as executor:
+            futures = [executor.submit(_put_chunks_worker, sftp_client if i == 0 else None, queues[i]) for i in range(nchannels)]
+            try:
+                with reader if reader is not None else open(localpath, 'rb') as fl:
+                    offset = 0
+                    nchunks = 0
+                    while offset < size:
+                        data = fl.read(min(HIGH_THROUGHPUT_CHUNK_SIZE, size - offset))
+                        if not data:
+                            raise IOError(f'{localpath} is smaller than expected')
+                        if not _hand_out(nchunks % nchannels, (offset, data)):
+                            break
+                        offset += len(data)
+                        nchunks += 1
+            finally:
+                for index in range(nchannels):
+                    _hand_out(index, None)
+            # raises the first error of the connections, if any
+            for future in futures:
+                future.result()
+
+        if (remote_size := sftp_client.stat(remotepath).st_size) != size:
+            raise IOError(f"size mismatch in put!  {remote_size} != {size}")
 
     def run(self, file: File):
         try:
-            with paramiko.SSHClient() as client:
-                client.load_system_host_keys()
-                client.set_missing_host_key_policy(AutoAddPolicy if self.params.auto_add_keys else RejectPolicy)
-                client.connect(self.params.hostname,
-                    port=int(self.params.port),
-                    username=self.params.username,
-                    password=self.params.password,
-                    )
-                logging.debug(f"Try opening an sftp connection to {self.params.hostname}")
-                with client.open_sftp() as sftp_client:
-                    sftp_client.chdir(self.params.destination)
-                    rel_filename = str(PurePosixPath(*file._relative_filename.parts))
-                    makedirs(sftp_client, posixpath.dirname(rel_filename))
-                    sftp_client.put(file._filename, rel_filename, callback=SftpProgressPercentage(file, self))
-                    remote_filename_full = sftp_client.normalize(rel_filename)
-                    logging.debug(f"File {remote_filename_full} has been written")
+            for attempt in range(2):
+                with self._pool.session() as sftp_client:
+                    try:
+                        remote_filename_full, copied_from = self._upload(sftp_client, file)
+                    except Exception:
+                        # retry once on a fresh connection if this one was dropped
+                        if attempt == 0 and not is_alive(sftp_client):
+                            logging.warning(f"Connection to {self.params.hostname} lost, reconnecting")
+                            continue
+                        raise
+                    break
         except Exception as e:
+            # the remote directory tree may have changed underneath us
+            self._remote_dirs.clear()
             logging.exception(f'SftpUploaderOperation.run exception')
             return str(e)
         else:
             #add object URL to metadata
-            file.operation_metadata[self.index] = {'sftp url':
-                f'sftp://{self.params.username}@{self.params.hostname}:{int(self.params.port)}{remote_filename_full}'}
+            file.operation_metadata[self.index] = {'sftp url': f'{self._dedup_destination}{remote_filename_full}'}
+            file.operation_metadata[self.index].update(checksum_metadata(compute_digests(file, self._checksum_algorithms)))
+            if copied_from is not None:
+                file.operation_metadata[self.index]['sftp copied from'] = f'{self._dedup_destination}{copied_from}'
             logging.debug(f"{file.operation_metadata[self.index]=}")
         return None
 
@@ -221,14 +587,117 @@ class SftpProgressPercentage(object):
     def __init__(self, file: File, operation: Operation):
         self._file = file
         self._last_percentage = 0
+        self._last_bytes = 0
         self._operation = operation
+        self._lock = Lock()
 
     def __call__(self, bytes_so_far: int, bytes_total: int):
-        percentage = (bytes_so_far / bytes_total) * 100
-        if int(percentage) > self._last_percentage:
-            self._last_percentage = int(percentage)
-            self._file.update_progressbar(self._operation.index, self._last_percentage)
+        # concurrent transfers of ranges may report their totals out of order
+        with self._lock:
+            nbytes = bytes_so_far - self._last_bytes
+            self._last_bytes = max(bytes_so_far, self._last_bytes)
+            percentage = int((bytes_so_far / bytes_total) * 100)
+            if percentage > self._last_percentage:
+                self._last_percentage = percentage
+            else:
+                percentage = None
+        if percentage is not None:
+            self._file.update_progressbar(self._operation.index, percentage)
+        # called after every chunk that was written: wait here to limit the bandwidth,
+        # without holding the lock, so concurrent transfers do not wait for each other
+        self._operation.throttle(nbytes)
+
+
+class TransferredBytes:
+    """
+    Thread-safe counter of the bytes written by one or more concurrent transfers of a file,
+    forwarding the total to a paramiko-style progress callback.
+    """
+    def __init__(self, size: int, callback: Callable[[int, int], None]):
+        self._size = size
+        self._callback = callback
+        self._transferred = 0
+        self._lock = Lock()
+
+    def __call__(self, bytes_amount: int):
+        with self._lock:
+            self._transferred += bytes_amount
+            transferred = self._transferred
+        # the callback may sleep to limit the bandwidth
+        self._callback(transferred, self._size)
+
+def put_range(sftp_client: paramiko.SFTPClient, localpath: str, remotepath: str, mode: str, start: int, end: int, progress: Callable[[int], None], reader: Optional[HashingReader] = None):
+    """
+    Write bytes start to end of localpath into remotepath, using pipelined write requests.
+    If reader is provided, localpath is read through it instead.
+    """
+    with reader if reader is not None else open(localpath, 'rb') as fl, sftp_client.open(remotepath, mode) as fr:
+        fr.set_pipelined(True)
+        fl.seek(start)
+        fr.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = fl.read(min(HIGH_THROUGHPUT_CHUNK_SIZE, remaining))
+            if not data:
+                raise IOError(f'{localpath} is smaller than expected')
+            fr.write(data)
+            remaining -= len(data)
+            progress(len(data))
+
+class SftpConnectionPool:
+    """
+    A thread-safe pool of authenticated SFTP sessions, which are reused across uploads
+    to avoid a full SSH handshake for every single file.
+    Sessions are created on demand, so the pool grows up to the number of concurrent uploads.
+    Sessions whose transport is no longer active are discarded and replaced with new ones.
+    """
+    def __init__(self, connect: Callable[[], Tuple[paramiko.SSHClient, paramiko.SFTPClient]]):
+        self._connect = connect
+        self._lock = Lock()
+        self._idle: List[Tuple[paramiko.SSHClient, paramiko.SFTPClient]] = []
+        self._closed = False
+
+    @contextmanager
+    def session(self) -> Iterator[paramiko.SFTPClient]:
+        client, sftp_client = self._acquire()
+        try:
+            yield sftp_client
+        finally:
+            self._release(client, sftp_client)
+
+    def _acquire(self) -> Tuple[paramiko.SSHClient, paramiko.SFTPClient]:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('SFTP connection pool has been closed')
+            while self._idle:
+                client, sftp_client = self._idle.pop()
+                if is_alive(sftp_client):
+                    return client, sftp_client
+                logging.debug('SftpConnectionPool: discarding stale connection')
+                client.close()
+        # connect outside of the lock, as this may take a while
+        return self._connect()
+
+    def _release(self, client: paramiko.SSHClient, sftp_client: paramiko.SFTPClient):
+        with self._lock:
+            if not self._closed and is_alive(sftp_client):
+                self._idle.append((client, sftp_client))
+                return
+        client.close()
 
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle = self._idle[:]
+            self._idle.clear()
+        for client, _ in idle:
+            client.close()
+
+def is_alive(sftp_client: paramiko.SFTPClient) -> bool:
+    channel = sftp_client.get_channel()
+    return channel is not None and \
+        not channel.closed and \
+        channel.get_transport().is_active()
 
 # the following methods have been inspired by pysftp
 def isdir(sftp_client: paramiko.SFTPClient, remotepath: str):
@@ -243,15 +712,60 @@ def isfile(sftp_client: paramiko.SFTPClient, remotepath: str):
     except IOError: # no such file
         return False
 
-def makedirs(sftp_client: paramiko.SFTPClient, remotedir: str, mode=777):
+class UnsupportedError(IOError):
+    """
+    Raised when the server does not support an SFTP extension.
+    """
+
+def copy_remote(sftp_client: paramiko.SFTPClient, source: str, destination: str, size: int):
+    """
+    Copy size bytes of source into destination, on the server, without transferring them,
+    using the copy-data extension of OpenSSH 9.0 and later.
+    Raises UnsupportedError if the server does not support it.
+    """
+    with sftp_client.open(source, 'rb') as fs, sftp_client.open(destination, 'wb') as fd:
+        try:
+            sftp_client._request(CMD_EXTENDED, 'copy-data', fs.handle, int64(0), int64(size), fd.handle, int64(0))
+        except IOError as e:
+            if e.errno is None and 'unsupported' in str(e).lower():
+                raise UnsupportedError(str(e))
+            raise
+    if (remote_size := sftp_client.stat(destination).st_size) != size:
+        raise IOError(f"size mismatch in copy!  {remote_size} != {size}")
+
+def remove_symlink(sftp_client: paramiko.SFTPClient, remotepath: str):
+    """
+    Remove remotepath if it is a symlink.
+    """
+    try:
+        if S_ISLNK(sftp_client.lstat(remotepath).st_mode):
+            sftp_client.remove(remotepath)
+    except IOError: # no such file
+        pass
+
+def makedirs(sftp_client: paramiko.SFTPClient, remotedir: str, mode=777, cache: Optional[Set[str]] = None):
+    """
+    Create remotedir and its missing parents.
+    If cache is provided, it is used to skip the directories that are already known to exist,
+    and is updated with those that were found or created.
+    """
+    if cache is not None and remotedir in cache:
+        return
     if isdir(sftp_client, remotedir):
         pass
     elif isfile(sftp_client, remotedir):
         raise OSError(f'a file with the same name as the remotedir {remotedir} already exists')
     else:
         head, tail = posixpath.split(remotedir)
-        if head and not isdir(sftp_client, head):
-            makedirs(sftp_client, head, mode)
+        if head:
+            makedirs(sftp_client, head, mode, cache)
         if tail:
-            sftp_client.mkdir(remotedir, mode=int(str(mode), 8))
+            try:
+                sftp_client.mkdir(remotedir, mode=int(str(mode), 8))
+            except IOError:
+                # another session may have created it in the meantime
+                if not isdir(sftp_client, remotedir):
+                    raise
+    if cache is not None:
+        cache.add(remotedir)
         
\ No newline at end of file
@@ -0,0 +1,92 @@
+import logging
+import os
+from fnmatch import fnmatch
+from typing import Dict, Final, Optional, Sequence, Type
+
+from .file import File
+
+# a byte delays a file as much as being saved 1/QUEUE_SIZE_RATE seconds later,
+# so large files are overtaken by smaller ones for a bounded amount of time only
+QUEUE_SIZE_RATE: Final[float] = 10 * 1024 * 1024
+# a file in a priority class delays it as much as being saved this many seconds
+# later than a file in the class above it
+QUEUE_CLASS_DELAY: Final[float] = 60.0
+
+class QueuePolicy:
+    """
+    Decides in which order files waiting for an operation are launched.
+
+    Every file gets a key once, when it is saved, and files with the smallest
+    key go first, in the order in which they were saved when keys are equal.
+    Keys are fixed, allowing the scheduler to keep its queues as binary heaps.
+    To prevent starvation, policies other than FIFO derive the key from
+    the time the file was saved plus a penalty: a file can only be overtaken
+    by files that were saved at most that penalty later.
+
+    This base class is the FIFO policy.
+    """
+    NAME: str = 'fifo'
+    DESCRIPTION: str = 'in the order they were saved'
+
+    def key(self, file: File, now: float) -> float:
+        return 0.0
+
+class SmallestFirstPolicy(QueuePolicy):
+    NAME = 'smallest'
+    DESCRIPTION = 'smallest files first'
+
+    def key(self, file: File, now: float) -> float:
+        try:
+            size = os.path.getsize(file.filename)
+        except OSError:
+            size = 0
+        return now + size / QUEUE_SIZE_RATE
+
+class OldestFirstPolicy(QueuePolicy):
+    """
+    Orders files by modification time: files that were found when monitoring
+    started go first, oldest first. Files saved since then cannot be older
+    than a file that is already waiting, so the waiting ones cannot starve.
+    """
+    NAME = 'oldest'
+    DESCRIPTION = 'oldest files first'
+
+    def key(self, file: File, now: float) -> float:
+        try:
+            return min(os.path.getmtime(file.filename), now)
+        except OSError:
+            return now
+
+class PriorityClassesPolicy(QueuePolicy):
+    """
+    Files matching the first glob pattern go first, followed by those matching
+    the second one, and so on. Files matching none of them go last.
+    Patterns are matched against the path relative to the monitored directory.
+    """
+    NAME = 'patterns'
+    DESCRIPTION = 'files matching these patterns first'
+
+    def __init__(self, patterns: Sequence[str]):
+        self._patterns: Final[Sequence[str]] = tuple(patterns)
+
+    def key(self, file: File, now: float) -> float:
+        filename = str(file.relative_filename) if file.relative_filename is not None else file.filename
+        priority_class = next((index for index, pattern in enumerate(self._patterns) if fnmatch(filename, pattern)), len(self._patterns))
+        return now + priority_class * QUEUE_CLASS_DELAY
+
+QUEUE_POLICIES: Final[Dict[str, Type[QueuePolicy]]] = {
+    policy.NAME: policy for policy in (QueuePolicy, SmallestFirstPolicy, OldestFirstPolicy, PriorityClassesPolicy)
+}
+
+def queue_policy(name: str, patterns: Optional[str] = None) -> QueuePolicy:
+    """
+    Returns the policy called name. For the priority classes policy,
+    patterns is a comma separated list of glob patterns, highest priority first.
+    Unknown names fall back to FIFO.
+    """
+    if name == PriorityClassesPolicy.NAME:
+        return PriorityClassesPolicy([pattern.strip() for pattern in (patterns or '').split(',') if pattern.strip()])
+    if name not in QUEUE_POLICIES:
+        logging.warning(f'queue_policy: unknown policy {name}, using FIFO')
+        return QueuePolicy()
+    return QUEUE_POLICIES[name]()
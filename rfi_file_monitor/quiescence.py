@@ -0,0 +1,180 @@
+import logging
+import os
+from fnmatch import fnmatch
+from threading import Condition, Thread
+from time import time
+from typing import Callable, Dict, Final, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+# interval between two consecutive scans of the directories, in seconds
+QUIESCENCE_POLL_INTERVAL: Final[float] = 1.0
+# directories modified less than this many seconds before they were last listed
+# are listed again, as entries added within the same mtime tick would go unnoticed
+# on filesystems with coarse timestamps
+QUIESCENCE_MTIME_GRANULARITY: Final[float] = 2.0
+
+# size and mtime in ns, or None if the file has not been seen yet
+_Signature = Optional[Tuple[int, int]]
+
+class _Directory(NamedTuple):
+    mtime_ns: int
+    listed_at: float
+    names: Set[str]
+    subdirs: List[str]
+
+class QuiescenceDetector(Thread):
+    """
+    Finds the files that are created in path, optionally including its subdirectories,
+    and reports them once their size and modification time have remained
+    unchanged for period seconds. Meant for network filesystems such as NFS and SMB,
+    where filesystem events are often missing or delivered in batches,
+    so it does not rely on them: every interval the tree is scanned with os.scandir.
+
+    The files that exist when the detector starts are left to the BacklogIngester.
+    To keep scans cheap, a directory is only listed again if its modification time
+    changed since the previous scan, or if it contains files that have not settled yet.
+    Only the entries that are new or not settled are inspected: on Windows their
+    attributes come with the listing, on other platforms an lstat per file remains necessary.
+    Files that disappeared are dropped silently.
+
+    The callbacks are invoked from this thread, with the path of the file:
+    created_cb when a new file is found, and callback when it is quiescent.
+    """
+    def __init__(self,
+        period: float,
+        callback: Callable[[str], None],
+        path: str,
+        created_cb: Callable[[str], None],
+        recursive: bool = False,
+        ignore_patterns: Sequence[str] = (),
+        interval: float = QUIESCENCE_POLL_INTERVAL):
+
+        super().__init__(daemon=True)
+        self._period = period
+        self._callback = callback
+        self._path = os.path.normpath(path)
+        self._created_cb = created_cb
+        self._recursive = recursive
+        self._ignore_patterns = tuple(ignore_patterns)
+        self._interval = interval
+        self._cond = Condition()
+        # directory -> filename -> (signature, time when it was last seen changing)
+        self._tracked: Final[Dict[str, Dict[str, Tuple[_Signature, float]]]] = dict()
+        # only accessed from this thread
+        self._directories: Final[Dict[str, _Directory]] = dict()
+        self._should_exit: bool = False
+
+    def add(self, file_path: str):
+        """
+        Track a file that was found by other means.
+        """
+        directory, name = os.path.split(file_path)
+        with self._cond:
+            self._tracked.setdefault(directory, dict())[name] = (None, time())
+
+    def stop(self):
+        with self._cond:
+            self._should_exit = True
+            self._tracked.clear()
+            self._cond.notify()
+
+    def run(self):
+        # the initial scan only records the existing entries
+        self._scan_tree(initial=True)
+        while True:
+            with self._cond:
+                self._cond.wait(self._interval)
+                if self._should_exit:
+                    return
+            self._scan_tree(initial=False)
+
+    def _scan_tree(self, initial: bool):
+        visited: Set[str] = set()
+        pending: List[str] = [self._path]
+        while pending:
+            directory = pending.pop()
+            visited.add(directory)
+            pending.extend(self._scan(directory, initial))
+        # forget the directories that were removed
+        for directory in self._directories.keys() - visited:
+            del self._directories[directory]
+
+    def _scan(self, directory: str, initial: bool) -> List[str]:
+        # returns the subdirectories that need to be scanned as well
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            self._directories.pop(directory, None)
+            return []
+
+        known = self._directories.get(directory)
+        with self._cond:
+            tracked = set(self._tracked.get(directory, ()))
+        if known is not None and not tracked and known.mtime_ns == mtime_ns and \
+            known.listed_at - mtime_ns / 1e9 > QUIESCENCE_MTIME_GRANULARITY:
+            # no entries were added or removed, and there is nothing left to check
+            return known.subdirs
+
+        listed_at = time()
+        names: Set[str] = set()
+        subdirs: List[str] = []
+        signatures: Dict[str, Tuple[int, int]] = dict()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self._recursive:
+                                subdirs.append(entry.path)
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                    except OSError:
+                        continue
+                    if any(fnmatch(entry.name, pattern) for pattern in self._ignore_patterns):
+                        continue
+                    names.add(entry.name)
+                    if initial or (entry.name not in tracked and known is not None and entry.name in known.names):
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    signatures[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            logging.warning(f"QuiescenceDetector: could not scan {directory}")
+            return known.subdirs if known is not None else []
+        self._directories[directory] = _Directory(mtime_ns, listed_at, names, subdirs)
+        if initial:
+            return subdirs
+
+        now = time()
+        created = []
+        quiescent = []
+        with self._cond:
+            if self._should_exit:
+                return []
+            files = self._tracked.setdefault(directory, dict())
+            for name in signatures.keys() - files.keys():
+                # a new file
+                files[name] = (signatures[name], now)
+                created.append(os.path.join(directory, name))
+            for name, (signature, since) in list(files.items()):
+                if name not in signatures:
+                    # the file is gone, or was added after the listing started
+                    if signature is not None or now - since >= self._period:
+                        del files[name]
+                elif signatures[name] != signature:
+                    files[name] = (signatures[name], now)
+                elif now - since >= self._period:
+                    del files[name]
+                    quiescent.append(os.path.join(directory, name))
+            if not files:
+                del self._tracked[directory]
+
+        for file_path in created:
+            logging.debug(f"QuiescenceDetector: found {file_path}")
+            self._created_cb(file_path)
+        for file_path in quiescent:
+            logging.debug(f"QuiescenceDetector: {file_path} is quiescent")
+            self._callback(file_path)
+        return subdirs
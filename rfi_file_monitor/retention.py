@@ -0,0 +1,107 @@
+import gzip
+import json
+import logging
+import os
+from collections import deque
+from threading import Lock
+from time import time
+from typing import Deque, Dict, Final, List, Optional, Tuple
+
+from .file import File, FileStatus
+
+# interval between two consecutive evictions, in seconds
+RETENTION_INTERVAL: Final[int] = 5
+
+class FileHistory:
+    """
+    Compact on-disk history of the files that were removed from the list,
+    stored as gzip-compressed JSON lines, one per file.
+    Every run appends a new gzip member to the file.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._file = gzip.open(path, 'at', compresslevel=1, encoding='utf-8')
+
+    def write(self, files: List[File]):
+        for file in files:
+            self._file.write(json.dumps({
+                'filename': file.filename,
+                'created': file.created,
+                'status': str(file.status),
+                'operation_metadata': file.operation_metadata,
+            }, default=str) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class FileRetention:
+    """
+    Decides which finished files are removed from the list, to keep memory usage flat
+    during long runs: files are evicted in the order they finished, either when more than
+    max_rows files are listed, or when they succeeded longer than max_age seconds ago.
+    Failed files are only evicted to respect max_rows.
+    Files that are still being processed are never evicted.
+
+    file_done may be called from any thread, evict is called periodically by the owner
+    of the files dict, while holding its lock.
+    """
+    def __init__(self, max_rows: Optional[int] = None, max_age: Optional[float] = None, history: Optional[FileHistory] = None):
+        self._max_rows = max_rows
+        self._max_age = max_age
+        self._history = history
+        self._lock = Lock()
+        # (time when the file finished, file), in order of finishing
+        self._succeeded: Deque[Tuple[float, File]] = deque()
+        self._failed: Deque[Tuple[float, File]] = deque()
+
+    def file_done(self, file: File):
+        with self._lock:
+            if file.status == FileStatus.SUCCESS:
+                self._succeeded.append((time(), file))
+            else:
+                self._failed.append((time(), file))
+
+    def evict(self, files_dict: Dict[str, File]) -> List[File]:
+        """
+        Remove the files that exceed the retention policy from files_dict,
+        archive them and return them, so their rows can be removed as well.
+        """
+        evicted = []
+        now = time()
+        with self._lock:
+            if self._max_age is not None:
+                while self._succeeded and now - self._succeeded[0][0] > self._max_age:
+                    evicted.append(self._succeeded.popleft()[1])
+            if self._max_rows is not None:
+                excess = len(files_dict) - len(evicted) - self._max_rows
+                while excess > 0 and (self._succeeded or self._failed):
+                    # the oldest of both queues
+                    if not self._failed or (self._succeeded and self._succeeded[0][0] <= self._failed[0][0]):
+                        evicted.append(self._succeeded.popleft()[1])
+                    else:
+                        evicted.append(self._failed.popleft()[1])
+                    excess -= 1
+
+        for file in evicted:
+            # the path may have been reused by a new file in the meantime
+            if files_dict.get(file.filename) is file:
+                del files_dict[file.filename]
+
+        if evicted and self._history is not None:
+            try:
+                self._history.write(evicted)
+            except OSError:
+                logging.exception('FileRetention: could not archive removed files')
+
+        for file in evicted:
+            file.status = FileStatus.REMOVED_FROM_LIST
+
+        if evicted:
+            logging.debug(f"FileRetention: removed {len(evicted)} files from the list")
+        return evicted
+
+    def close(self):
+        if self._history is not None:
+            self._history.close()
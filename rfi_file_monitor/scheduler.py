@@ -0,0 +1,331 @@
+import heapq
+import logging
+import os
+from collections import deque
+from itertools import count
+from threading import Condition, Thread
+from time import time
+from typing import Callable, Deque, Final, Iterator, List, Optional, Sequence, Set, Tuple
+
+from .file import File, FileStatus
+from .job import Job, WorkerPool
+from .journal import Journal
+from .autotune import ConcurrencyTuner
+from .operation import Operation
+from .priority import QueuePolicy
+
+# upper bound on the number of threads: operations are mostly waiting for I/O,
+# so this is not related to the number of CPUs
+MAX_JOBS: Final[int] = 256
+
+#pylint: disable=no-member
+DEFAULT_JOBS: Final[int] = max((len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()) // 2, 1)
+
+def resolve_dependencies(operations: Sequence[Operation]) -> Tuple[Tuple[int, ...], ...]:
+    """
+    Returns for each operation the indices of the operations it depends on.
+    Operations without explicit dependencies depend on the operation before them.
+    Dependencies must refer to earlier operations, which guarantees that
+    the graph is acyclic. A ValueError is raised otherwise.
+    """
+    dependencies = []
+    for index, operation in enumerate(operations):
+        if operation.depends_on is None:
+            dependencies.append((index - 1,) if index > 0 else ())
+            continue
+        for dep in operation.depends_on:
+            if not isinstance(dep, int) or not 0 <= dep < index:
+                raise ValueError(f'Operation {index + 1} ({operation.NAME}) can only depend on earlier operations, not on {dep}')
+        dependencies.append(tuple(sorted(set(operation.depends_on))))
+    return tuple(dependencies)
+
+class Scheduler:
+    """
+    Event-driven scheduler that moves files through their lifecycle.
+
+    Files waiting to be promoted from CREATED to SAVED are kept in a queue
+    ordered by deadline, which is serviced by a single timer thread.
+    Files that were SAVED get a Job, whose operations are dispatched to
+    a pool of persistent worker threads as soon as their dependencies succeeded.
+    Every operation is a stage with its own queue: when a worker finishes an
+    operation, the operations that became ready are queued, and the stages are
+    drained, downstream first, to finish files that are already running.
+    Within a stage, files are launched in the order chosen by queue_policy,
+    which assigns every file a priority key when it is saved. The queues are
+    binary heaps ordered by that key, and then by the order in which files were queued.
+
+    By default at most max_threads operations run at the same time.
+    In pipeline mode, every stage gets its own budget of max_threads workers
+    instead, so that different files can occupy different operations at the same time.
+    Operations that declare a concurrency_limit never run for more files than that,
+    in both modes, so a slow destination cannot take all workers away from the others.
+    With autotune enabled, a ConcurrencyTuner picks the number of files per operation
+    within these limits, and windows_cb is called with the new values when they change.
+    Files whose first operation could not be launched are marked as QUEUED.
+    If a journal is provided, saved files and the outcome of their operations are recorded in it.
+    If file_done_cb is provided, it is called with every file whose job has finished,
+    while holding the scheduler lock.
+
+    All public methods are thread-safe and cost O(log n) per event
+    (for a given number of operations), with n the number of files waiting.
+    """
+
+    def __init__(self, operations: Sequence[Operation], max_threads: int, promotion_delay: Optional[float] = None, pipeline: bool = False, journal: Optional[Journal] = None, file_done_cb: Optional[Callable[[File], None]] = None,
+        autotune: bool = False, windows_cb: Optional[Callable[[Tuple[int, ...]], None]] = None, queue_policy: Optional[QueuePolicy] = None):
+        self._operations: Final[Tuple[Operation, ...]] = tuple(operations)
+        self._dependencies: Final[Tuple[Tuple[int, ...], ...]] = resolve_dependencies(self._operations)
+        self._dependents: Final[Tuple[Tuple[int, ...], ...]] = tuple(
+            tuple(index for index, deps in enumerate(self._dependencies) if stage in deps)
+            for stage in range(len(self._operations))
+        )
+        self._roots: Final[Tuple[int, ...]] = tuple(index for index, deps in enumerate(self._dependencies) if not deps)
+        nstages = len(self._operations)
+        self._max_threads: Final[int] = max(int(max_threads), 1)
+        self._pipeline: Final[bool] = pipeline
+        self._stage_limits: Final[Tuple[int, ...]] = tuple(
+            min(self._max_threads, max(int(operation.concurrency_limit), 1)) if operation.concurrency_limit is not None else self._max_threads
+            for operation in self._operations
+        )
+        self._global_limit: Final[int] = sum(self._stage_limits) if pipeline else self._max_threads
+        self._tuner: Final[Optional[ConcurrencyTuner]] = ConcurrencyTuner(
+            [operation.NAME for operation in self._operations], self._stage_limits) if autotune else None
+        self._windows_cb: Final[Optional[Callable[[Tuple[int, ...]], None]]] = windows_cb
+        self._promotion_delay: Final[Optional[float]] = promotion_delay
+        self._journal: Final[Optional[Journal]] = journal
+        self._file_done_cb: Final[Optional[Callable[[File], None]]] = file_done_cb
+        self._queue_policy: Final[QueuePolicy] = queue_policy if queue_policy is not None else QueuePolicy()
+        self._cond = Condition()
+        # since the promotion delay is constant, deadlines are appended in order
+        self._created: Deque[Tuple[float, File]] = deque()
+        # heaps of (priority, sequence number, job)
+        self._queues: Final[List[List[Tuple[float, int, Job]]]] = [[] for _ in range(nstages)]
+        self._sequence: Final[Iterator[int]] = count()
+        self._nrunning: Final[List[int]] = [0] * nstages
+        self._nrunning_total: int = 0
+        # number of jobs that have not launched any operation yet
+        self._nwaiting: int = 0
+        self._jobs: Final[Set[Job]] = set()
+        self._should_exit: bool = False
+        self._timer_thread = Thread(target=self._promotion_worker, daemon=True)
+        self._pool: Final[WorkerPool] = WorkerPool(self._global_limit)
+
+    @property
+    def operations(self) -> Tuple[Operation, ...]:
+        return self._operations
+
+    @property
+    def dependencies(self) -> Tuple[Tuple[int, ...], ...]:
+        return self._dependencies
+
+    @property
+    def dependents(self) -> Tuple[Tuple[int, ...], ...]:
+        return self._dependents
+
+    @property
+    def stage_limits(self) -> Tuple[int, ...]:
+        """
+        The maximum number of files that may be processed at the same time by each operation.
+        """
+        return self._stage_limits
+
+    @property
+    def windows(self) -> Tuple[int, ...]:
+        """
+        The number of files that each operation may currently process at the same time.
+        """
+        with self._cond:
+            return self._tuner.windows if self._tuner is not None else self._stage_limits
+
+    @property
+    def autotune(self) -> bool:
+        """
+        True if the concurrency of the operations is tuned, which requires the sizes of the files.
+        """
+        return self._tuner is not None
+
+    @property
+    def queue_policy(self) -> QueuePolicy:
+        return self._queue_policy
+
+    @property
+    def pipeline(self) -> bool:
+        return self._pipeline
+
+    @property
+    def njobs_running(self) -> int:
+        with self._cond:
+            return self._nrunning_total
+
+    @property
+    def nwaiting(self) -> int:
+        with self._cond:
+            return self._nwaiting
+
+    def wait_for_nwaiting(self, limit: int, timeout: Optional[float] = None) -> bool:
+        """
+        Block until fewer than limit files are waiting for their job to be launched.
+        Returns False if timeout expired first.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._should_exit or self._nwaiting < limit, timeout)
+
+    def start(self):
+        self._pool.start()
+        self._timer_thread.start()
+
+    def stop(self):
+        """
+        Stop the timer thread and the worker pool,
+        drop all pending files and ask running jobs to exit.
+        """
+        with self._cond:
+            self._should_exit = True
+            self._created.clear()
+            for queue in self._queues:
+                queue.clear()
+            for job in self._jobs:
+                job.should_exit = True
+            self._jobs.clear()
+            self._cond.notify_all()
+        self._pool.shutdown()
+        if self._timer_thread.is_alive():
+            self._timer_thread.join()
+
+    def join(self):
+        """
+        Wait until the workers have finished the operations that were running when stop was called.
+        Operations can only be cleaned up after this, as they may still be in use until then.
+        """
+        self._pool.join()
+
+    def file_created(self, file: File):
+        """
+        Register a newly CREATED file. If status promotion is active,
+        it will be promoted to SAVED once the delay has expired.
+        """
+        if self._promotion_delay is None:
+            return
+        with self._cond:
+            if self._should_exit:
+                return
+            self._created.append((file.created + self._promotion_delay, file))
+            if len(self._created) == 1:
+                self._cond.notify()
+
+    def file_saved(self, file: File) -> bool:
+        """
+        Promote a CREATED file to SAVED, and launch or queue its job.
+        Returns False if the file was not in the CREATED state.
+        """
+        # the policy may need to stat the file, which is done without holding the lock
+        priority = self._queue_policy.key(file, time())
+        with self._cond:
+            if self._should_exit or file.status != FileStatus.CREATED:
+                return False
+            self._promote(file, priority)
+        return True
+
+    def job_deferred(self, job: Job, index: int):
+        """
+        Called by a job from its worker thread when operation index returned a future:
+        the worker is released, but the operation has not finished yet.
+        """
+        with self._cond:
+            if self._should_exit or job not in self._jobs:
+                return
+            self._nrunning[index] -= 1
+            self._nrunning_total -= 1
+            self._dispatch()
+
+    def job_done(self, job: Job, index: int, elapsed: float = 0.0, nbytes: int = 0, deferred: bool = False):
+        """
+        Called by a job when operation index has finished, after elapsed seconds,
+        processing a file of nbytes. Unless deferred, this happens in its worker thread,
+        otherwise the worker was released already through job_deferred.
+        """
+        with self._cond:
+            if self._should_exit or job not in self._jobs:
+                return
+            if not deferred:
+                self._nrunning[index] -= 1
+                self._nrunning_total -= 1
+            for ready in job.complete(index):
+                self._enqueue(job, ready)
+            if self._tuner is not None:
+                self._tuner.record(index, elapsed, nbytes, job.succeeded(index))
+                if self._tuner.adjust() and self._windows_cb is not None:
+                    self._windows_cb(self._tuner.windows)
+            if self._journal is not None:
+                self._journal.operation_done(job.file, index, FileStatus.SUCCESS if job.succeeded(index) else FileStatus.FAILURE)
+                if job.done:
+                    self._journal.file_done(job.file, job.file.status)
+            if job.done:
+                self._jobs.discard(job)
+                if self._file_done_cb is not None:
+                    self._file_done_cb(job.file)
+            self._dispatch()
+
+    def _promote(self, file: File, priority: float):
+        logging.debug(f"Scheduler: promoting {file.filename} to SAVED")
+        file.update_status(-1, FileStatus.SAVED)
+        if self._journal is not None:
+            self._journal.file_saved(file)
+        job = Job(self, file, priority)
+        self._jobs.add(job)
+        for root in self._roots:
+            self._enqueue(job, root)
+        self._dispatch()
+        if not job.started:
+            logging.debug(f"Scheduler: adding {file.filename} to queue for future processing")
+            file.update_status(-1, FileStatus.QUEUED)
+            self._nwaiting += 1
+
+    def _enqueue(self, job: Job, stage: int):
+        heapq.heappush(self._queues[stage], (job.priority, next(self._sequence), job))
+
+    def _dispatch(self):
+        # downstream stages first, to finish files that are already running
+        for stage in reversed(range(len(self._queues))):
+            queue = self._queues[stage]
+            limit = self._tuner.window(stage) if self._tuner is not None else self._stage_limits[stage]
+            while queue and \
+                self._nrunning[stage] < limit and \
+                self._nrunning_total < self._global_limit:
+                self._launch(heapq.heappop(queue)[2], stage)
+            if queue and self._tuner is not None and self._nrunning[stage] >= limit:
+                self._tuner.saturated(stage)
+
+    def _launch(self, job: Job, stage: int):
+        logging.debug(f"Scheduler: launching operation {stage} of job for {job.file.filename}")
+        if not job.started:
+            if job.file.status == FileStatus.QUEUED:
+                self._nwaiting -= 1
+                self._cond.notify_all()
+            job.start()
+        self._nrunning[stage] += 1
+        self._nrunning_total += 1
+        self._pool.submit(job, stage)
+
+    def _promotion_worker(self):
+        with self._cond:
+            while not self._should_exit:
+                if not self._created:
+                    self._cond.wait()
+                    continue
+                deadline, file = self._created[0]
+                timeout = deadline - time()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                self._created.popleft()
+                if file.status != FileStatus.CREATED:
+                    continue
+                # the policy may need to stat the file, which is done without holding the lock
+                self._cond.release()
+                try:
+                    priority = self._queue_policy.key(file, time())
+                finally:
+                    self._cond.acquire()
+                # the file may have been saved in the meantime
+                if not self._should_exit and file.status == FileStatus.CREATED:
+                    self._promote(file, priority)
@@ -11,6 +11,12 @@ EXPAND_AND_FILL: Final[Dict[str, Any]] = dict(hexpand=True, vexpand=True, halign
 
 PREFERENCES_CONFIG_FILE = Path(GLib.get_user_config_dir(), 'rfi-file-monitor', 'prefs.yml')
 
+JOURNAL_FILE = Path(GLib.get_user_data_dir(), 'rfi-file-monitor', 'journal.sqlite')
+
+DEDUP_CACHE_FILE = Path(GLib.get_user_data_dir(), 'rfi-file-monitor', 'dedup.sqlite')
+
+HISTORY_FILE = Path(GLib.get_user_data_dir(), 'rfi-file-monitor', 'history.jsonl.gz')
+
 def add_action_entries(
     map: Gio.ActionMap,
     action: str,
@@ -50,6 +56,10 @@ class WidgetParams:
     def _spinbutton_value_changed_cb(self, spinbutton: Gtk.SpinButton, param_name: str):
         self._params[param_name] = spinbutton.get_value()
 
+    @final
+    def _comboboxtext_changed_cb(self, comboboxtext: Gtk.ComboBoxText, param_name: str):
+        self._params[param_name] = comboboxtext.get_active_id()
+
     @final
     def register_widget(self, widget: Gtk.Widget, param_name: str):
 
@@ -69,6 +79,9 @@ class WidgetParams:
             #pylint: disable=used-before-assignment
             self._params[param_name] = tmp if (tmp := widget.get_text().strip()) != "" else widget.get_placeholder_text()
             self._signal_ids[param_name] = widget.connect("changed", self._entry_changed_cb, param_name)
+        elif isinstance(widget, Gtk.ComboBoxText):
+            self._params[param_name] = widget.get_active_id()
+            self._signal_ids[param_name] = widget.connect("changed", self._comboboxtext_changed_cb, param_name)
         else:
             raise NotImplementedError(f"register_widget: no support for {type(widget).__name__}")
 
@@ -99,6 +112,8 @@ class WidgetParams:
                         widget.set_text("")
                     else:
                         widget.set_text(value)
+                elif isinstance(widget, Gtk.ComboBoxText):
+                    widget.set_active_id(value)
                 else:
                     raise NotImplementedError(f"update_from_dict: no support for {type(widget).__name__}")
 
@@ -31,9 +31,9 @@ setup(
         "PyGObject",
         "boto3",
         "munch",
-        "watchdog",
+        "watchdog>=2.1",
         "PyYAML",
-        "paramiko"
+        "paramiko>=3.2"
     ],
     entry_points={
         "rfi_file_monitor.operations": [
@@ -55,6 +55,7 @@ setup(
         ],
         'console_scripts': [
             'rfi-file-monitor=rfi_file_monitor:main',
+            'rfi-file-monitor-headless=rfi_file_monitor.headless:main',
         ],
     },
     license="BSD license",